@@ -1,16 +1,27 @@
+import os
 import re
 import time
-import json
+import uuid
 import docker
-from os import path
-from datetime import datetime
-from flask import Flask, render_template, request
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from datetime import datetime, timedelta
+from urllib.error import HTTPError
+from urllib.parse import urlparse
+from urllib.request import urlopen
+from flask import Flask, Response, render_template, request, jsonify
 from flask_wtf import Form
 from flask_pymongo import PyMongo
 from flask_bootstrap import Bootstrap
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError, OperationFailure
 from wtforms import SubmitField
 
-from logs.get_logs import get_logs_for_container
+import metrics
+from docker_util import get_docker_client, log_call_stats
+from logs.get_logs import get_logs_for_container, ship_new_logs, \
+    upload_spooled, drain_spool, count_spooled
 
 import logging
 
@@ -23,214 +34,1104 @@ logger.handlers.extend(guni_logger.handlers)
 logging.basicConfig(level=logging.INFO, format=LOGGING_FMT)
 logger.info("Logging is working!")
 
-MAX_SESSIONS = 8
+# Each session reserves this many CPUs and MB of memory, which are enforced
+# as limits on its container. The number of sessions (warm pool containers
+# included) on each host is bounded by what the host can fit after setting
+# aside its own reserve, and optionally by CWC_MAX_SESSIONS.
+SESSION_CPUS = float(os.environ.get('CWC_SESSION_CPUS', 2))
+SESSION_MEMORY_MB = int(os.environ.get('CWC_SESSION_MEMORY_MB', 7168))
+HOST_RESERVED_CPUS = float(os.environ.get('CWC_HOST_RESERVED_CPUS', 0))
+HOST_RESERVED_MEMORY_MB = int(os.environ.get('CWC_HOST_RESERVED_MEMORY_MB',
+                                             4096))
+MAX_SESSIONS = int(os.environ.get('CWC_MAX_SESSIONS', 0)) or None
+_max_sessions = {}
+
+# The Docker daemons sessions are placed on, given as a comma-separated list
+# of URLs, each optionally followed by '=<address>' giving the address at
+# which its published ports are reached, e.g.
+# CWC_DOCKER_HOSTS=unix:///var/run/docker.sock,tcp://10.0.0.5:2375=10.0.0.5
+# By default, only the daemon given by the environment is used.
+LOCAL_DOCKER = 'local'
+
+
+def _parse_docker_hosts(spec):
+    hosts = OrderedDict()
+    for entry in spec.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        url, _, address = entry.partition('=')
+        hosts[url] = address or None
+    if not hosts:
+        hosts[LOCAL_DOCKER] = None
+    return hosts
+
+
+DOCKER_HOSTS = _parse_docker_hosts(os.environ.get('CWC_DOCKER_HOSTS', ''))
+
+
 class SessionLimitExceeded(Exception):
     pass
 
 
+class PortsExhausted(Exception):
+    pass
+
+
 app = Flask(__name__)
 app.config["MONGO_URI"] = 'mongodb://localhost:27017/myDatabase'
 app.config['SECRET_KEY'] = 'dev_key'
 mongo = PyMongo(app)
 Bootstrap(app)
-MY_CONTAINER_LIST = 'cwc_service_containers.json'
 TIME_FMT = '%Y%m%d%H%M%S'
 DAY = 86400  # a day in seconds.
 
+# The range of host ports (inclusive) leased out to session containers.
+PORT_MIN = int(os.environ.get('CWC_PORT_MIN', 8100))
+PORT_MAX = int(os.environ.get('CWC_PORT_MAX', 8199))
+
+# A port is leased before its container is started, so a lease younger than
+# this many seconds is never taken to be stale.
+LEASE_GRACE = int(os.environ.get('CWC_LEASE_GRACE', 300))
+SESSIONS_ID = 'sessions'
+
+# How long a launch token is remembered, to stop the same form being
+# submitted twice.
+TOKEN_TTL = int(os.environ.get('CWC_TOKEN_TTL', DAY))
+
+# The port exposed inside the container by each interface, and the path at
+# which the interface is served.
+INTERFACE_PORTS = {'CLIC': 8000, 'SBGN': 3000}
+INTERFACE_PATHS = {'CLIC': '/clic/bio', 'SBGN': ''}
+
+# An optional line printed by the container once it is fully started. If it
+# is not given, readiness is only judged by whether the interface responds.
+STARTUP_MARKER = os.environ.get('CWC_STARTUP_MARKER')
+
+# The number of already-booted containers to keep ready for each interface,
+# e.g. CWC_WARM_POOL_CLIC=2.
+WARM_POOL_SIZE = {interface: int(os.environ.get('CWC_WARM_POOL_%s' % interface,
+                                                1))
+                  for interface in INTERFACE_PORTS}
+_pool_lock = threading.Lock()
+
+# Every process refills the pools, so each warm container is started into
+# one of a fixed set of slots, reserved in the db. A slot reserved for a
+# start that didn't finish in POOL_RESERVATION_TIMEOUT seconds is freed.
+POOL_RESERVATION_TIMEOUT = int(os.environ.get('CWC_POOL_RESERVATION_TIMEOUT',
+                                              300))
+
+# Launches run in the background so that slow docker calls don't tie up the
+# web workers. The number of launches waiting or in progress across all
+# workers is bounded by MAX_LAUNCH_QUEUE.
+LAUNCH_WORKERS = int(os.environ.get('CWC_LAUNCH_WORKERS', 2))
+MAX_LAUNCH_QUEUE = int(os.environ.get('CWC_LAUNCH_QUEUE', 8))
+# A launch not done within LAUNCH_JOB_TIMEOUT seconds of being queued or
+# started is taken to have died with its process, and is failed.
+LAUNCH_JOB_TIMEOUT = int(os.environ.get('CWC_LAUNCH_JOB_TIMEOUT', 600))
+_launch_executor = ThreadPoolExecutor(max_workers=LAUNCH_WORKERS)
+
+# Teardowns (log collection, upload, and removal) also run in the background,
+# with at most TEARDOWN_WORKERS running at once in each process.
+TEARDOWN_WORKERS = int(os.environ.get('CWC_TEARDOWN_WORKERS', 2))
+_teardown_executor = ThreadPoolExecutor(max_workers=TEARDOWN_WORKERS)
+# A teardown whose record hasn't been updated in TEARDOWN_STALE seconds is
+# taken to have been lost with its process, and is run again.
+TEARDOWN_STALE = int(os.environ.get('CWC_TEARDOWN_STALE', 3600))
+
+# Monitor settings, all in seconds: how often sessions are checked, how long
+# the logs may stay silent, and how long a session may run at all. Each
+# sweep checks up to MONITOR_WORKERS containers at once, and gives up on a
+# check after CHECK_TIMEOUT.
+CHECK_INTERVAL = int(os.environ.get('CWC_CHECK_INTERVAL', 60*15))
+IDLE_TIMEOUT = int(os.environ.get('CWC_IDLE_TIMEOUT', 3600))
+MAX_SESSION_DURATION = int(os.environ.get('CWC_MAX_SESSION_DURATION', DAY/2))
+MONITOR_WORKERS = int(os.environ.get('CWC_MONITOR_WORKERS', 4))
+CHECK_TIMEOUT = int(os.environ.get('CWC_CHECK_TIMEOUT', 60))
+_monitor_executor = ThreadPoolExecutor(max_workers=MONITOR_WORKERS)
+_checks_in_flight = set()
+_checks_lock = threading.Lock()
 
-def _load_id_dict():
-    if not path.exists(MY_CONTAINER_LIST):
-        return {}
-    id_dict = {}
-    with open(MY_CONTAINER_LIST, 'r') as f:
-        id_dict_strs = json.load(f)
-    for id_val, data in id_dict_strs.items():
-        for key, val in data.items():
-            if key == 'date':
-                data[key] = datetime.strptime(val, TIME_FMT)
-        id_dict[id_val] = data
-    return id_dict
-
-
-def _dump_id_dict(id_dict):
-    json_dict = {}
-    for id_val, data in id_dict.items():
-        json_data = data.copy()
-        for key, val in data.items():
-            if key == 'date':
-                json_data[key] = val.strftime(TIME_FMT)
-        json_dict[id_val] = json_data
-    with open(MY_CONTAINER_LIST, 'w') as f:
-        json.dump(json_dict, f)
+# While sessions run, the monitor ships their new logs to S3 every
+# SHIP_INTERVAL seconds (0 to only collect them at teardown), several
+# sessions at a time.
+SHIP_INTERVAL = int(os.environ.get('CWC_SHIP_INTERVAL', 60))
+SHIP_WORKERS = int(os.environ.get('CWC_SHIP_WORKERS', 4))
+_ship_executor = ThreadPoolExecutor(max_workers=SHIP_WORKERS)
+_ships_in_flight = set()
+_ships_lock = threading.Lock()
+
+# Logs collected at teardown are spooled to disk, and the monitor uploads
+# them every SPOOL_INTERVAL seconds. At cleanup, the spool is drained for up
+# to SPOOL_DRAIN_TIMEOUT seconds, and anything left is uploaded next start.
+SPOOL_INTERVAL = int(os.environ.get('CWC_SPOOL_INTERVAL', 10))
+SPOOL_DRAIN_TIMEOUT = int(os.environ.get('CWC_SPOOL_DRAIN_TIMEOUT', 600))
+
+# When there is no room, users wait in line for a session. A ticket that
+# hasn't been polled for QUEUE_ABANDON seconds is dropped from the line, and
+# at most MAX_WAITING users can wait at once. Until enough sessions have
+# ended to go by, a session is assumed to last DEFAULT_SESSION_LENGTH.
+QUEUE_ABANDON = int(os.environ.get('CWC_QUEUE_ABANDON', 60))
+MAX_WAITING = int(os.environ.get('CWC_MAX_WAITING', 50))
+DEFAULT_SESSION_LENGTH = int(os.environ.get('CWC_DEFAULT_SESSION_LENGTH',
+                                            1800))
+
+
+def _ensure_ttl_index(coll, key, ttl):
+    """Create an expiring index, or change how long it keeps documents."""
+    try:
+        coll.create_index(key, expireAfterSeconds=ttl)
+    except OperationFailure as e:
+        if e.code != 85:  # IndexOptionsConflict
+            raise
+        mongo.db.command('collMod', coll.name,
+                         index={'keyPattern': {key: 1},
+                                'expireAfterSeconds': ttl})
+        logger.info("Set the TTL of %s.%s to %d seconds."
+                    % (coll.name, key, ttl))
     return
 
 
-def _add_my_container(cont_id, interface):
-    """Update the json with a new container."""
-    id_dict = _load_id_dict()
+def _ensure_indexes():
+    """Create the indexes the session registry relies on."""
+    mongo.db.containers.create_index('cont_id', unique=True)
+    mongo.db.containers.create_index([('interface', ASCENDING),
+                                      ('warm', ASCENDING)])
+    mongo.db.containers.create_index('date')
+    mongo.db.containers.create_index('host')
+    # Tokens from before they were dated would never expire.
+    mongo.db.tokens.delete_many({'date': {'$exists': False}})
+    mongo.db.tokens.create_index('token', unique=True)
+    _ensure_ttl_index(mongo.db.tokens, 'date', TOKEN_TTL)
+    mongo.db.waiting.create_index('ticket_id', unique=True)
+    mongo.db.waiting.create_index([('status', ASCENDING),
+                                   ('date', ASCENDING)])
+    mongo.db.waiting.create_index('interface')
+    _ensure_ttl_index(mongo.db.waiting, 'last_seen', DAY)
+    mongo.db.launch_jobs.create_index('job_id', unique=True)
+    mongo.db.launch_jobs.create_index([('status', ASCENDING),
+                                       ('deadline', ASCENDING)])
+    _ensure_ttl_index(mongo.db.launch_jobs, 'date', DAY)
+    mongo.db.teardowns.create_index('cont_id', unique=True)
+    # Also serves the sort by date when estimating wait times.
+    _ensure_ttl_index(mongo.db.teardowns, 'date', 7*DAY)
+    return
 
-    if cont_id not in id_dict.keys():
-        logger.info("Adding %s to list of my containers." % cont_id)
-        id_dict[cont_id] = {'interface': interface, 'date': datetime.utcnow()}
-        _dump_id_dict(id_dict)
-        success = True
-    else:
-        logger.info("This container was already registered.")
-        success = False
 
-    return success
+def _list_my_containers(**query):
+    """Get the records of my containers matching the query."""
+    return list(mongo.db.containers.find(query, {'_id': False}))
+
+
+def _add_my_container(cont_id, interface, name, host, port, warm=False):
+    """Add a new container to the registry."""
+    try:
+        mongo.db.containers.insert_one({'cont_id': cont_id,
+                                        'interface': interface,
+                                        'date': datetime.utcnow(),
+                                        'created': datetime.utcnow(),
+                                        'name': name, 'host': host,
+                                        'port': port,
+                                        'warm': warm, 'ready': False,
+                                        'draining': False, 'log_since': None,
+                                        'last_activity': None})
+    except DuplicateKeyError:
+        logger.info("This container was already registered.")
+        return False
+    logger.info("Adding %s to list of my containers." % cont_id)
+    return True
 
 
 def _pop_my_container(cont_id, pop=True):
-    """Update the json with the removal of a container."""
-    id_dict = _load_id_dict()
+    """Remove a container from the registry, returning its record."""
+    if pop:
+        ret = mongo.db.containers.find_one_and_delete({'cont_id': cont_id},
+                                                      {'_id': False})
+    else:
+        ret = _get_my_container(cont_id)
 
-    if cont_id not in id_dict.keys():
+    if ret is None:
         logger.info("This container isn't mine or doesn't exist.")
-        ret = None
-    else:
-        if pop:
-            ret = id_dict.pop(cont_id)
-        else:
-            ret = id_dict.get(cont_id)
+    elif pop:
         logger.info("Removing %s from list of my containers which had "
                     "metadata: %s." % (cont_id, ret))
-        _dump_id_dict(id_dict)
-
     return ret
 
 
+def _list_sessions_started_before(date, **query):
+    """Get the records of my containers started before the given date."""
+    query['date'] = {'$lt': date}
+    return _list_my_containers(**query)
+
+
+def _get_my_container(cont_id):
+    """Get the record of one of my containers, or None if it isn't mine."""
+    return mongo.db.containers.find_one({'cont_id': cont_id}, {'_id': False})
+
+
+def _probe_warm_containers(interface):
+    """Probe an interface's warm containers, oldest first, until one is
+    found to be ready, marking it so."""
+    for data in mongo.db.containers.find({'interface': interface,
+                                          'warm': True, 'draining': False},
+                                         {'_id': False},
+                                         sort=[('date', ASCENDING)]):
+        try:
+            if _is_session_ready(data['cont_id'], data):
+                return
+        except Exception as e:
+            logger.warning("Could not probe %s: %s" % (data['cont_id'], e))
+    return
+
+
+def _claim_warm_container(interface=None):
+    """Take a warm container out of the pool, optionally for an interface.
+
+    For an interface, the pool is probed first, so that containers known to
+    be ready are preferred, followed by the oldest, as it is the most likely
+    to have finished booting. Its date and log cursor are reset so that its
+    session timers start now.
+    """
+    query = {'warm': True, 'draining': False}
+    if interface is not None:
+        query['interface'] = interface
+        _probe_warm_containers(interface)
+    data = mongo.db.containers.find_one_and_update(
+        query,
+        {'$set': {'warm': False, 'date': datetime.utcnow(),
+                  'log_since': int(time.time()), 'last_activity': None}},
+        projection={'_id': False},
+        sort=[('ready', DESCENDING), ('date', ASCENDING)],
+        return_document=ReturnDocument.AFTER
+        )
+    if data is None:
+        return None
+    cont_id = data['cont_id']
+    logger.info("Claimed warm %s container %s." % (data['interface'], cont_id))
+    return cont_id, data
+
+
+def _count_warm_containers(interface):
+    return mongo.db.containers.count_documents({'interface': interface,
+                                                'warm': True,
+                                                'draining': False})
+
+
+def _retire_warm_container():
+    """Stop a warm container to free its slot for a cold start."""
+    claimed = _claim_warm_container()
+    if claimed is None:
+        return False
+    cont_id, _ = claimed
+    _stop_container(cont_id, collect_logs=False)
+    return True
+
+
+def _pool_slot_in_use(slot):
+    """Check whether a pool slot still holds, or is starting, a container."""
+    if slot['cont_id'] is None:
+        age = (datetime.utcnow() - slot['date']).total_seconds()
+        return age < POOL_RESERVATION_TIMEOUT
+    return mongo.db.containers.count_documents(
+        {'cont_id': slot['cont_id'], 'warm': True, 'draining': False},
+        limit=1
+        ) > 0
+
+
+def _reserve_pool_slot(interface):
+    """Reserve a free slot in an interface's warm pool.
+
+    Returns the id of the slot, or None if they are all in use.
+    """
+    for i in range(WARM_POOL_SIZE[interface]):
+        slot_id = '%s-%d' % (interface, i)
+        slot = mongo.db.pool_slots.find_one({'_id': slot_id})
+        if slot is not None and _pool_slot_in_use(slot):
+            continue
+        reservation = {'cont_id': None, 'date': datetime.utcnow()}
+        # Only take the slot if no one else took it since we looked.
+        if slot is None:
+            try:
+                mongo.db.pool_slots.insert_one(dict(reservation, _id=slot_id))
+            except DuplicateKeyError:
+                continue
+        else:
+            res = mongo.db.pool_slots.update_one(
+                {'_id': slot_id, 'cont_id': slot['cont_id'],
+                 'date': slot['date']},
+                {'$set': reservation}
+                )
+            if not res.modified_count:
+                continue
+        return slot_id
+    return None
+
+
+def _fill_pool(interface):
+    """Start warm containers until the pool for the interface is full."""
+    # Only one fill at a time per process, others would just race this one.
+    if not _pool_lock.acquire(blocking=False):
+        return
+    try:
+        while _count_warm_containers(interface) < WARM_POOL_SIZE[interface]:
+            # Users waiting in line get free slots before the pool does.
+            if _count_waiting():
+                break
+            # Other processes may be filling the pool at the same time.
+            slot_id = _reserve_pool_slot(interface)
+            if slot_id is None:
+                break
+            try:
+                cont_id, _, _, _ = _run_container(INTERFACE_PORTS[interface],
+                                                  interface, warm=True)
+            except BaseException as e:
+                mongo.db.pool_slots.delete_one({'_id': slot_id,
+                                                'cont_id': None})
+                if isinstance(e, (SessionLimitExceeded, PortsExhausted)):
+                    logger.info("No room to add to the %s warm pool."
+                                % interface)
+                    break
+                raise
+            mongo.db.pool_slots.update_one({'_id': slot_id},
+                                           {'$set': {'cont_id': cont_id}})
+    except Exception as e:
+        logger.error("Failed to fill the %s warm pool." % interface)
+        logger.exception(e)
+    finally:
+        _pool_lock.release()
+    return
+
+
+def _fill_pools():
+    for interface in INTERFACE_PORTS:
+        _fill_pool(interface)
+
+
+def _fill_pools_async():
+    """Refill the warm pools without holding up the caller."""
+    th = threading.Thread(target=_fill_pools, daemon=True)
+    th.start()
+    return th
+
+
+def _mark_draining(cont_id):
+    """Flag a container as being torn down, returning its record.
+
+    None is returned if the container isn't mine or is already draining.
+    """
+    return mongo.db.containers.find_one_and_update(
+        {'cont_id': cont_id, 'draining': False},
+        {'$set': {'draining': True}},
+        projection={'_id': False},
+        return_document=ReturnDocument.AFTER
+        )
+
+
+def _mark_ready(cont_id, data):
+    res = mongo.db.containers.update_one({'cont_id': cont_id, 'ready': False},
+                                         {'$set': {'ready': True}})
+    if res.modified_count:
+        boot_time = (datetime.utcnow() - data['created']).total_seconds()
+        metrics.observe(mongo.db.metrics, 'cwc_boot_to_ready_seconds',
+                        boot_time, interface=data['interface'])
+    return
+
+
+def _interface_responds(host, port, interface):
+    """Check whether the interface answers HTTP requests on the given port."""
+    url = 'http://%s:%d%s' % (_host_address(host), port,
+                              INTERFACE_PATHS[interface])
+    try:
+        with urlopen(url, timeout=2) as res:
+            return res.status < 500
+    except HTTPError as e:
+        return e.code < 500
+    except Exception:
+        # Until the server inside is up, connections are refused or reset.
+        return False
+
+
+def _has_startup_marker(cont_id, host):
+    client = _get_client(host)
+    cont = client.containers.get(cont_id)
+    return STARTUP_MARKER in cont.logs().decode('utf-8', errors='replace')
+
+
+def _is_session_ready(cont_id, data):
+    """Probe a container to see if its interface can be used yet."""
+    if data.get('ready'):
+        return True
+    if STARTUP_MARKER and not _has_startup_marker(cont_id, data['host']):
+        return False
+    if not _interface_responds(data['host'], data['port'],
+                               data['interface']):
+        return False
+    _mark_ready(cont_id, data)
+    return True
+
+
+def _check_idle(data, now):
+    """Stop a session if its logs have been silent for too long."""
+    cont_id = data['cont_id']
+    start_date = data['date']
+    logger.info("Examining %s" % cont_id)
+
+    # Grab the date from the latest SPG log entry written since the last
+    # check.
+    client = _get_client(data['host'], timeout=CHECK_TIMEOUT)
+    cont = client.containers.get(cont_id)
+    log_until = int(time.time())
+    cont_logs = cont.logs(since=data.get('log_since'), until=log_until)
+    date_strings = re.findall('SPG:\s+;;\s+\[(.*?)\]',
+                              cont_logs.decode('utf-8'))
+    if date_strings:
+        latest_log_date = datetime.strptime(date_strings[-1],
+                                            '%m/%d/%Y %H:%M:%S')
+    elif data.get('last_activity') is not None:
+        latest_log_date = data['last_activity']
+    else:
+        logger.info("WARNING: Did not find any date strings in container "
+                    "logs for %s." % cont_id)
+        latest_log_date = start_date
+    latest_log_date = max(latest_log_date, start_date)
+    mongo.db.containers.update_one(
+        {'cont_id': cont_id},
+        {'$set': {'log_since': log_until, 'last_activity': latest_log_date}}
+        )
+
+    # Check whether the logs have been silent for too long (neglect).
+    log_stalled = (now - latest_log_date).total_seconds()
+    if log_stalled > IDLE_TIMEOUT:
+        logger.info("Container %s timed out after %ds of empty logs."
+                    % (cont_id, log_stalled))
+        _begin_teardown(cont_id)
+    return
+
+
+def _check_idle_once(data, now):
+    """Check a container, unless a previous check of it is still going."""
+    cont_id = data['cont_id']
+    with _checks_lock:
+        if cont_id in _checks_in_flight:
+            logger.warning("A check of %s is still running, skipping it."
+                           % cont_id)
+            return
+        _checks_in_flight.add(cont_id)
+    try:
+        _check_idle(data, now)
+    finally:
+        with _checks_lock:
+            _checks_in_flight.discard(cont_id)
+    return
+
+
+def _ship_session_logs(data):
+    """Ship what a session has logged since its logs were last shipped."""
+    # Get the latest record, in case it was shipped since it was listed.
+    cont_id = data['cont_id']
+    data = _get_my_container(cont_id)
+    if data is None or data.get('draining'):
+        return
+    client = _get_client(data['host'])
+    cont = client.containers.get(cont_id)
+    if cont.status != 'running':
+        return
+    state = data.get('shipped') or {}
+    timings = {}
+    ship_new_logs(cont, data['interface'], state, timings)
+    mongo.db.containers.update_one({'cont_id': cont_id},
+                                   {'$set': {'shipped': state}})
+    for upload_time in timings['uploads']:
+        metrics.observe(mongo.db.metrics, 's3_upload_seconds', upload_time)
+    metrics.inc(mongo.db.metrics, 'cwc_archive_bytes_total',
+                timings['bytes'])
+    return
+
+
+def _ship_session_logs_once(data):
+    """Ship a session's logs, unless they are already being shipped."""
+    cont_id = data['cont_id']
+    with _ships_lock:
+        if cont_id in _ships_in_flight:
+            return
+        _ships_in_flight.add(cont_id)
+    try:
+        _ship_session_logs(data)
+    except Exception as e:
+        logger.error("Failed to ship the logs of %s." % cont_id)
+        logger.exception(e)
+    finally:
+        with _ships_lock:
+            _ships_in_flight.discard(cont_id)
+    return
+
+
+def ship_logs():
+    """Ship the new logs of every session, as long as the monitor runs."""
+    while True:
+        time.sleep(SHIP_INTERVAL)
+        try:
+            for data in _list_my_containers(warm=False, draining=False):
+                _ship_executor.submit(_ship_session_logs_once, data)
+        except Exception as e:
+            logger.error("Failed to list the sessions to ship logs for.")
+            logger.exception(e)
+    return
+
+
+def _record_uploads(uploads):
+    """Record the time taken and size of each upload from the spool."""
+    for upload_time, num_bytes in uploads:
+        metrics.observe(mongo.db.metrics, 's3_upload_seconds', upload_time)
+        metrics.inc(mongo.db.metrics, 'cwc_archive_bytes_total', num_bytes)
+    return
+
+
+def upload_spool():
+    """Upload the spooled logs, as long as the monitor runs."""
+    while True:
+        try:
+            _record_uploads(upload_spooled())
+        except Exception as e:
+            logger.error("Failed to upload from the spool.")
+            logger.exception(e)
+        time.sleep(SPOOL_INTERVAL)
+    return
+
+
 def _check_timers():
     """Look through the containers and stop any timed-out containers."""
     # The logs are utc time, and this generally avoids any time-zone issues.
     # Won't work in python 2.
     now = datetime.utcnow()
 
-    # This is not connected to the other dict instances deliberately. Do not
-    # try to make the dict shared, because the below for-loop could then have
-    # issues modifying an object while iterating over it.
-    id_dict = _load_id_dict()
-    logger.info("There are %d instances running." % len(id_dict))
+    # Sessions that have run for too long (hogging) can be found straight
+    # from the registry.
+    # Warm containers have no user yet, so their timers haven't started,
+    # and draining containers are already on their way out.
+    in_use = {'warm': False, 'draining': False}
+    too_old = now - timedelta(seconds=MAX_SESSION_DURATION)
+    for data in _list_sessions_started_before(too_old, **in_use):
+        logger.info("Container %s timed out after %d seconds of running."
+                    % (data['cont_id'], (now - data['date']).total_seconds()))
+        _begin_teardown(data['cont_id'])
 
-    # Go through all the containers...
-    client = docker.from_env()
-    for cont_id, data in id_dict.items():
-        start_date = data['date']
-        logger.info("Examining %s" % cont_id)
+    # Teardowns lost with the process running them are picked up again.
+    for data in _list_my_containers(draining=True):
+        if _claim_stale_teardown(data['cont_id']):
+            logger.info("Resuming teardown of %s." % data['cont_id'])
+            _teardown_executor.submit(_run_teardown, data['cont_id'])
 
-        # Grab the date from the latest SPG log entry.
-        cont = client.containers.get(cont_id)
-        cont_logs = cont.logs()
-        date_strings = re.findall('SPG:\s+;;\s+\[(.*?)\]',
-                                  cont_logs.decode('utf-8'))
-        if date_strings:
-            latest_log_date = datetime.strptime(date_strings[-1],
-                                                '%m/%d/%Y %H:%M:%S')
-        else:
-            logger.info("WARNING: Did not find any date strings in container "
-                        "logs for %s." % cont_id)
-            latest_log_date = start_date
-
-        # Check both whether the logs have been silent for more than a day
-        # (neglect) or whether the session has been running for more than 5
-        # days (hogging).
-        log_stalled = (now - latest_log_date).seconds
-        total_dur = (now - start_date).seconds
-        if log_stalled > 3600:
-            logger.info("Container %s timed out after %ds of empty logs."
-                        % (cont_id, log_stalled))
-            _stop_container(cont_id)
-        elif total_dur > DAY/2:
-            logger.info("Container %s timed out after %d seconds of running."
-                  % (cont_id, total_dur))
-            _stop_container(cont_id)
+    records = _list_my_containers(**in_use)
+    logger.info("There are %d sessions running." % len(records))
+
+    # Go through the rest of the containers, several at a time.
+    futures = [(data['cont_id'],
+                _monitor_executor.submit(_check_idle_once, data, now))
+               for data in records]
+    for cont_id, future in futures:
+        try:
+            future.result(timeout=CHECK_TIMEOUT)
+        except TimeoutError:
+            logger.warning("Check of %s did not finish within %ds."
+                           % (cont_id, CHECK_TIMEOUT))
+        except Exception as e:
+            logger.error("Failed to check %s." % cont_id)
+            logger.exception(e)
+    return
+
+
+def _seconds_to_next_check():
+    """Get the time until the next sweep is due.
+
+    This is the check interval, unless a session will run out its maximum
+    duration sooner.
+    """
+    wait = CHECK_INTERVAL
+    oldest = mongo.db.containers.find_one({'warm': False, 'draining': False},
+                                          sort=[('date', ASCENDING)])
+    if oldest is not None:
+        deadline = oldest['date'] + timedelta(seconds=MAX_SESSION_DURATION)
+        wait = min(wait, (deadline - datetime.utcnow()).total_seconds() + 1)
+    return max(wait, 1)
+
+
+def _record_sweep(start, duration):
+    logger.info("Sweep took %.1f seconds." % duration)
+    mongo.db.monitor.replace_one({'_id': 'last_sweep'},
+                                 {'start': start, 'duration': duration},
+                                 upsert=True)
+
+
+def _get_client(host, timeout=None):
+    """Get the Docker client for one of the DOCKER_HOSTS."""
+    return get_docker_client(timeout=timeout,
+                             base_url=None if host == LOCAL_DOCKER else host)
+
+
+def _is_local(host):
+    return host == LOCAL_DOCKER or host.startswith('unix://')
+
+
+def _host_address(host):
+    """Get the address at which a host's published ports can be reached."""
+    if DOCKER_HOSTS[host]:
+        return DOCKER_HOSTS[host]
+    if _is_local(host):
+        return 'localhost'
+    return urlparse(host).hostname
+
+
+def _dialogue_base(host, base_host):
+    """Get the base of the URL at which users reach sessions on a host."""
+    # Sessions on this machine are reached through the same name as the
+    # service itself.
+    if _is_local(host) and not DOCKER_HOSTS[host]:
+        return base_host
+    return 'http://' + _host_address(host)
+
+
+def _ensure_ports():
+    """Make sure there is a lease record for every port on every host.
+
+    Ports are leased per address, so daemons sharing a machine share its
+    ports.
+    """
+    # Leases from before sessions were spread over hosts.
+    mongo.db.ports.delete_many({'address': {'$exists': False}})
+    if 'port_1' in mongo.db.ports.index_information():
+        mongo.db.ports.drop_index('port_1')
+    mongo.db.ports.create_index([('address', ASCENDING), ('port', ASCENDING)],
+                                unique=True)
+    mongo.db.ports.create_index('cont_id')
+    for address in {_host_address(host) for host in DOCKER_HOSTS}:
+        for port in range(PORT_MIN, PORT_MAX + 1):
+            new_lease = {'cont_id': None, 'date': datetime.utcnow()}
+            mongo.db.ports.update_one({'address': address, 'port': port},
+                                      {'$setOnInsert': new_lease},
+                                      upsert=True)
     return
 
 
-def get_increment_port():
-    port_json = mongo.db.ports.find_one()
+def lease_port(host, lease_id):
+    """Lease the least recently used free port on a host to lease_id."""
+    port_json = mongo.db.ports.find_one_and_update(
+        {'address': _host_address(host), 'cont_id': None,
+         'port': {'$gte': PORT_MIN, '$lte': PORT_MAX}},
+        {'$set': {'cont_id': lease_id, 'date': datetime.utcnow()}},
+        sort=[('date', ASCENDING)],
+        return_document=ReturnDocument.AFTER
+        )
     if port_json is None:
-        port = 8000
-        mongo.db.ports.insert_one({'port': port})
+        raise PortsExhausted()
+    return port_json['port']
+
+
+def transfer_port(lease_id, new_lease_id):
+    mongo.db.ports.update_many({'cont_id': lease_id},
+                               {'$set': {'cont_id': new_lease_id}})
+
+
+def release_ports(lease_id):
+    """Return any ports leased to lease_id."""
+    mongo.db.ports.update_many({'cont_id': lease_id},
+                               {'$set': {'cont_id': None,
+                                         'date': datetime.utcnow()}})
+
+
+def reconcile_ports(host=None):
+    """Release leases held by anything other than an existing container.
+
+    If a host is given, only the ports at its address are reconciled. Hosts
+    may share an address, so an address is skipped unless the daemons of
+    all its hosts can be reached.
+    """
+    if host is None:
+        addresses = {_host_address(host) for host in DOCKER_HOSTS}
     else:
-        port = port_json['port']
-        mongo.db.ports.update_one({'port': port}, {'$set': {'port': port + 1}})
-        port += 1
-    return port
+        addresses = {_host_address(host)}
+    for address in addresses:
+        cont_ids = set()
+        try:
+            for addr_host in DOCKER_HOSTS:
+                if _host_address(addr_host) != address:
+                    continue
+                client = _get_client(addr_host)
+                cont_ids |= {cont.id
+                             for cont in client.containers.list(all=True)}
+        except Exception as e:
+            logger.warning("Could not list the containers at %s, not "
+                           "reconciling its ports: %s" % (address, e))
+            continue
+        _release_stale_leases(address, cont_ids)
+    return
+
+
+def _release_stale_leases(address, cont_ids):
+    """Release the leases at an address held by none of the containers.
+
+    Leases younger than LEASE_GRACE may be for containers still starting.
+    """
+    young = datetime.utcnow() - timedelta(seconds=LEASE_GRACE)
+    for port_json in mongo.db.ports.find({'address': address,
+                                          'cont_id': {'$ne': None},
+                                          'date': {'$lt': young}}):
+        if port_json['cont_id'] not in cont_ids:
+            logger.info("Releasing stale lease on %s:%d held by %s."
+                        % (port_json['address'], port_json['port'],
+                           port_json['cont_id']))
+            mongo.db.ports.update_one(
+                {'_id': port_json['_id'], 'cont_id': port_json['cont_id'],
+                 'date': port_json['date']},
+                {'$set': {'cont_id': None, 'date': datetime.utcnow()}}
+                )
+    return
+
+
+def get_max_sessions(host=None):
+    """Get how many sessions fit in the CPU and memory reservations.
+
+    If no host is given, this is the total over all the hosts. A host whose
+    daemon can't be reached has no room until it can be.
+    """
+    if host is None:
+        return sum(get_max_sessions(host) for host in DOCKER_HOSTS)
+    if host not in _max_sessions:
+        try:
+            info = _get_client(host).info()
+        except Exception as e:
+            logger.warning("Could not reach the daemon of %s: %s" % (host, e))
+            return 0
+        by_cpu = (info['NCPU'] - HOST_RESERVED_CPUS) // SESSION_CPUS
+        by_mem = ((info['MemTotal'] // 2**20 - HOST_RESERVED_MEMORY_MB)
+                  // SESSION_MEMORY_MB)
+        max_sessions = max(int(min(by_cpu, by_mem)), 0)
+        if MAX_SESSIONS is not None:
+            max_sessions = min(max_sessions, MAX_SESSIONS)
+        logger.info("Host %s fits %d sessions (%d by CPU, %d by memory)."
+                    % (host, max_sessions, by_cpu, by_mem))
+        _max_sessions[host] = max_sessions
+    return _max_sessions[host]
 
 
-def get_num_sessions():
-    sessions_json = mongo.db.sessions.find_one()
+def _get_available_memory_mb():
+    """Get the memory available on this host, or None if it is unknown."""
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    return None
+
+
+def _host_has_headroom(host):
+    """Check the measured load and free memory leave room for a session.
+
+    These can only be measured for daemons on this machine; other hosts are
+    admitted by their reservations alone.
+    """
+    if not _is_local(host):
+        return True
+    avail_mem = _get_available_memory_mb()
+    if avail_mem is not None \
+            and avail_mem - HOST_RESERVED_MEMORY_MB < SESSION_MEMORY_MB:
+        logger.info("Only %dMB of memory available." % avail_mem)
+        return False
+    load = os.getloadavg()[0]
+    if load + SESSION_CPUS > (os.cpu_count() or 1) - HOST_RESERVED_CPUS:
+        logger.info("The host is already loaded at %.1f." % load)
+        return False
+    return True
+
+
+def _can_admit(host):
+    """Check if another session fits on the host."""
+    return (get_num_sessions(host) < get_max_sessions(host)
+            and _host_has_headroom(host))
+
+
+def _pick_host():
+    """Choose the least loaded host with room for a session, if any."""
+    candidates = [host for host in DOCKER_HOSTS if _can_admit(host)]
+    if not candidates:
+        return None
+    return min(candidates,
+               key=lambda host: (get_num_sessions(host)
+                                 / max(get_max_sessions(host), 1)))
+
+
+def _sessions_id(host):
+    if host == LOCAL_DOCKER:
+        return SESSIONS_ID
+    return '%s@%s' % (SESSIONS_ID, host)
+
+
+def get_num_sessions(host=None):
+    """Get the number of sessions on a host, or on all hosts if None."""
+    if host is None:
+        return sum(get_num_sessions(host) for host in DOCKER_HOSTS)
+    sessions_json = mongo.db.sessions.find_one({'_id': _sessions_id(host)})
     if not sessions_json:
         return 0
     num_sessions = sessions_json['num_sessions']
     return num_sessions
 
 
-def increment_sessions():
-    sessions_json = mongo.db.sessions.find_one()
+def increment_sessions(host):
+    if not _host_has_headroom(host):
+        raise SessionLimitExceeded()
+    sessions_json = mongo.db.sessions.find_one_and_update(
+        {'_id': _sessions_id(host),
+         'num_sessions': {'$lt': get_max_sessions(host)}},
+        {'$inc': {'num_sessions': 1}},
+        return_document=ReturnDocument.AFTER
+        )
     if sessions_json is None:
-        reset_sessions()
-    num_sessions = sessions_json['num_sessions']
-    if num_sessions == MAX_SESSIONS:
+        # The host may not have a count yet, e.g. if it was added without a
+        # reset. Start it at zero, leaving the other hosts alone.
+        res = mongo.db.sessions.update_one(
+            {'_id': _sessions_id(host)},
+            {'$setOnInsert': {'num_sessions': 0}},
+            upsert=True
+            )
+        if res.upserted_id is not None:
+            return increment_sessions(host)
         raise SessionLimitExceeded()
-    mongo.db.sessions.update_one({'num_sessions': num_sessions},
-                                 {'$set': {'num_sessions': num_sessions + 1}})
-    return num_sessions + 1
+    return sessions_json['num_sessions']
 
 
-def decrement_sessions():
-    sessions_json = mongo.db.sessions.find_one()
+def decrement_sessions(host):
+    sessions_json = mongo.db.sessions.find_one_and_update(
+        {'_id': _sessions_id(host), 'num_sessions': {'$gt': 0}},
+        {'$inc': {'num_sessions': -1}},
+        return_document=ReturnDocument.AFTER
+        )
     if sessions_json is None:
-        reset_sessions()
-    num_sessions = sessions_json['num_sessions']
-    mongo.db.sessions.update_one({'num_sessions': num_sessions},
-                                 {'$set': {'num_sessions': num_sessions - 1}})
-    return num_sessions - 1
+        logger.warning("Session count on %s was already at zero." % host)
+        return 0
+    return sessions_json['num_sessions']
 
 
 def add_token(token):
-    mongo.db.tokens.insert_one({'token': token})
+    """Record a token, returning False if it was already recorded."""
+    try:
+        mongo.db.tokens.insert_one({'token': token,
+                                    'date': datetime.utcnow()})
+    except DuplicateKeyError:
+        return False
+    return True
 
 
-def has_token(token):
-    tokens = mongo.db.tokens.find()
-    if tokens is None:
-        return False
-    for tok in tokens:
-        if tok['token'] == token:
-            return True
-    return False
+def _expire_launch_jobs():
+    """Fail the launches whose process went away before they were done."""
+    res = mongo.db.launch_jobs.update_many(
+        {'status': {'$in': ['queued', 'running']},
+         'deadline': {'$lt': datetime.utcnow()}},
+        {'$set': {'status': 'failed',
+                  'error': 'The launch was interrupted, please try again.'}}
+        )
+    if res.modified_count:
+        logger.warning("Failed %d launches that timed out."
+                       % res.modified_count)
+    return
+
+
+def _fail_unfinished_launches():
+    """Fail every launch still pending, for when no process is running."""
+    mongo.db.launch_jobs.update_many(
+        {'status': {'$in': ['queued', 'running']}},
+        {'$set': {'status': 'failed',
+                  'error': 'The service was restarted, please try again.'}}
+        )
+
+
+def _count_pending_launches():
+    _expire_launch_jobs()
+    return mongo.db.launch_jobs.count_documents(
+        {'status': {'$in': ['queued', 'running']}}
+        )
+
+
+def _launch_deadline():
+    return datetime.utcnow() + timedelta(seconds=LAUNCH_JOB_TIMEOUT)
+
+
+def _update_launch_job(job_id, **fields):
+    mongo.db.launch_jobs.update_one({'job_id': job_id}, {'$set': fields})
+
+
+def _submit_launch(interface_port_num, app_name, extension, base_host,
+                   ticket_id=None):
+    """Queue a launch in the background and return the id of its job."""
+    job_id = uuid.uuid4().hex
+    mongo.db.launch_jobs.insert_one({'job_id': job_id, 'interface': app_name,
+                                     'status': 'queued',
+                                     'date': datetime.utcnow(),
+                                     'deadline': _launch_deadline()})
+    _launch_executor.submit(_run_launch_job, job_id, interface_port_num,
+                            app_name, extension, base_host, ticket_id,
+                            time.time())
+    logger.info('Queued launch job %s for the %s interface.'
+                % (job_id, app_name))
+    return job_id
+
+
+def _run_launch_job(job_id, interface_port_num, app_name, extension,
+                    base_host, ticket_id=None, submitted=None):
+    """Get a container for a session, recording the outcome on the job."""
+    _update_launch_job(job_id, status='running', deadline=_launch_deadline())
+    try:
+        claimed = _claim_warm_container(app_name)
+        if claimed is not None:
+            cont_id, data = claimed
+            cont_name = data['name']
+            host = data['host']
+            port = data['port']
+        else:
+            if _pick_host() is None:
+                _retire_warm_container()
+            cont_id, cont_name, host, port = \
+                _run_container(interface_port_num, app_name)
+    except (SessionLimitExceeded, PortsExhausted):
+        _update_launch_job(job_id, status='failed',
+                           error='There are currently too many sessions, '
+                                 'please come back later.')
+        # Someone else got the slot first, so back in line, at the front.
+        if ticket_id is not None:
+            _requeue_ticket(ticket_id)
+        return
+    except Exception as e:
+        logger.error('Launch job %s failed.' % job_id)
+        logger.exception(e)
+        _update_launch_job(job_id, status='failed',
+                           error='Failed to start a session.')
+        return
+    url = _dialogue_base(host, base_host) + (':%d' % port + extension)
+    logger.info('Will redirect to address: %s' % url)
+    _update_launch_job(job_id, status='done', container_id=cont_id,
+                       container_name=cont_name, dialogue_url=url)
+    if submitted is not None:
+        metrics.observe(mongo.db.metrics, 'cwc_launch_seconds',
+                        time.time() - submitted, interface=app_name,
+                        source='cold' if claimed is None else 'warm')
+    log_call_stats()
+    _fill_pools_async()
+    return
+
+
+def _count_waiting():
+    return mongo.db.waiting.count_documents(
+        {'status': 'waiting',
+         'last_seen': {'$gt': datetime.utcnow()
+                       - timedelta(seconds=QUEUE_ABANDON)}}
+        )
+
+
+def _enqueue(interface_port_num, app_name, extension, base_host):
+    """Put a user in line for a session, returning their ticket id."""
+    ticket_id = uuid.uuid4().hex
+    now = datetime.utcnow()
+    mongo.db.waiting.insert_one({'ticket_id': ticket_id,
+                                 'interface': app_name,
+                                 'interface_port': interface_port_num,
+                                 'extension': extension,
+                                 'base_host': base_host,
+                                 'status': 'waiting', 'job_id': None,
+                                 'date': now, 'last_seen': now})
+    logger.info('User %s is waiting for a %s session.'
+                % (ticket_id, app_name))
+    return ticket_id
+
+
+def _requeue_ticket(ticket_id):
+    mongo.db.waiting.update_one({'ticket_id': ticket_id},
+                                {'$set': {'status': 'waiting',
+                                          'job_id': None}})
+
+
+def _has_room():
+    """Check whether there is room for another launch.
+
+    This is whatever room is left over after the pending launches.
+    """
+    room = mongo.db.containers.count_documents({'warm': True,
+                                                'draining': False})
+    for host in DOCKER_HOSTS:
+        if _host_has_headroom(host):
+            room += max(get_max_sessions(host) - get_num_sessions(host), 0)
+    return _count_pending_launches() < room
+
+
+def _admit_waiting():
+    """Launch sessions for the users first in line, while there is room."""
+    while _has_room():
+        # The line is shared by the interfaces, as they share the slots.
+        alive = datetime.utcnow() - timedelta(seconds=QUEUE_ABANDON)
+        ticket = mongo.db.waiting.find_one_and_update(
+            {'status': 'waiting', 'last_seen': {'$gt': alive}},
+            {'$set': {'status': 'admitted'}},
+            sort=[('date', ASCENDING)],
+            return_document=ReturnDocument.AFTER
+            )
+        if ticket is None:
+            break
+        logger.info('Admitting %s from the line.' % ticket['ticket_id'])
+        job_id = _submit_launch(ticket['interface_port'], ticket['interface'],
+                                ticket['extension'], ticket['base_host'],
+                                ticket['ticket_id'])
+        mongo.db.waiting.update_one({'ticket_id': ticket['ticket_id']},
+                                    {'$set': {'job_id': job_id}})
+    return
+
+
+def _estimate_wait(position):
+    """Estimate the seconds until the user at position gets a session."""
+    recent = mongo.db.teardowns.find({'duration': {'$exists': True}},
+                                     sort=[('date', DESCENDING)], limit=20)
+    durations = [teardown['duration'] for teardown in recent]
+    if durations:
+        session_length = sum(durations) / len(durations)
+    else:
+        session_length = DEFAULT_SESSION_LENGTH
+    # On average a slot frees up every session_length / max_sessions.
+    return int(position * session_length / max(get_max_sessions(), 1))
 
 
 def _launch_app(interface_port_num, app_name, extension=''):
-    num_sessions = get_num_sessions()
-    if num_sessions >= MAX_SESSIONS:
-        logger.info('Number of sessions: %d' % num_sessions)
-        # TODO: this should be part of the index page with buttons
-        # greyed out
-        return 'There are currently too many sessions, please come back later.'
-    # Here we check if the same token was already used to start a session
+    if _count_pending_launches() >= MAX_LAUNCH_QUEUE:
+        logger.info('Launch queue is full.')
+        return ('Too many sessions are starting right now, please try again '
+                'in a minute.', 503)
+    # Here we check if the same token was already used to start a session,
+    # and add it to make sure it can't be reused, in one go.
     token = request.form['csrf_token']
-    if has_token(token):
+    if not add_token(token):
         # Flash could be nice but it gets placed on the home page instead of
         # the page with the dialogue for some reason
         # flash('You already have a session!')
         return ('', 204)
         #return 'You already have a running session, please stop it ' + \
         #    'and refresh the main page again to start another one.'
-    # We add the token to make sure it can't be reused
-    add_token(token)
-    port = get_increment_port()
     base_host = 'http://' + str(request.host).split(':')[0]
-    host = base_host + (':%d' % port + extension)
-    logger.info('Will redirect to address: %s' % host)
-    cont_id, cont_name = _run_container(port, interface_port_num, app_name)
+    # Anyone already waiting goes first, and launches already under way
+    # have dibs on the free slots.
+    if _count_waiting() or not _has_room():
+        logger.info('Number of sessions: %d' % get_num_sessions())
+        if _count_waiting() >= MAX_WAITING:
+            return ('There are currently too many sessions, please come back '
+                    'later.')
+        ticket_id = _enqueue(interface_port_num, app_name, extension,
+                             base_host)
+        _admit_waiting()
+        return render_template('waiting_room.html', manager_url=base_host,
+                               ticket_id=ticket_id, interface=app_name)
+    job_id = _submit_launch(interface_port_num, app_name, extension,
+                            base_host)
     logger.info('Start redirecting %s interface.' % app_name)
-    return render_template('launch_dialogue.html', dialogue_url=host,
-                           manager_url=base_host, container_id=cont_id,
-                           time_out=90, container_name=cont_name,
-                           interface=app_name)
+    return render_template('launch_dialogue.html', manager_url=base_host,
+                           job_id=job_id, time_out=300, interface=app_name)
 
 
 class ClicForm(Form):
@@ -259,52 +1160,266 @@ def launch_sbgn():
     return _launch_app(3000, 'SBGN')
 
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    in_use = {'warm': False, 'draining': False}
+    gauges = {
+        'cwc_active_sessions':
+            ("Sessions in use by a user.",
+             [({'host': host},
+               mongo.db.containers.count_documents(dict(in_use, host=host)))
+              for host in DOCKER_HOSTS]),
+        'cwc_warm_containers':
+            ("Containers booted and waiting for a user.",
+             [({'interface': interface},
+               mongo.db.containers.count_documents({'warm': True,
+                                                    'draining': False,
+                                                    'interface': interface}))
+              for interface in INTERFACE_PORTS]),
+        'cwc_draining_sessions':
+            ("Sessions being torn down.",
+             [({}, mongo.db.containers.count_documents({'draining': True}))]),
+        'cwc_leased_ports':
+            ("Host ports leased to containers.",
+             [({'address': address},
+               mongo.db.ports.count_documents({'address': address,
+                                               'cont_id': {'$ne': None}}))
+              for address in {_host_address(host) for host in DOCKER_HOSTS}]),
+        'cwc_waiting_users':
+            ("Users waiting in line for a session.", [({}, _count_waiting())]),
+        'cwc_spooled_artifacts':
+            ("Logs and archives waiting in the spool to be uploaded.",
+             [({}, count_spooled())]),
+        }
+    return Response(metrics.render(mongo.db.metrics, gauges),
+                    mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/end_session/<cont_id>', methods=['DELETE'])
 def stop_session(cont_id):
     logger.info("Request to end %s." % cont_id)
     assert cont_id, "Bad request. Need an id."
-    _stop_container(cont_id)
-    return 'Success!', 200
+    if not _begin_teardown(cont_id):
+        return 'No such session, or it is already ending.', 404
+    return 'Accepted', 202
+
+
+@app.route('/teardown_status/<cont_id>', methods=['GET'])
+def teardown_status(cont_id):
+    teardown = mongo.db.teardowns.find_one({'cont_id': cont_id},
+                                           {'_id': False})
+    if teardown is None:
+        return jsonify({'status': 'unknown', 'error': 'Unknown session.'}), 404
+    teardown['date'] = teardown['date'].strftime(TIME_FMT)
+    return jsonify(teardown)
+
+
+@app.route('/launch/<job_id>', methods=['GET'])
+def launch_page(job_id):
+    job = mongo.db.launch_jobs.find_one({'job_id': job_id})
+    if job is None:
+        return 'No such session.', 404
+    base_host = 'http://' + str(request.host).split(':')[0]
+    return render_template('launch_dialogue.html', manager_url=base_host,
+                           job_id=job_id, time_out=300,
+                           interface=job['interface'])
+
+
+@app.route('/queue_status/<ticket_id>', methods=['GET'])
+def queue_status(ticket_id):
+    now = datetime.utcnow()
+    ticket = mongo.db.waiting.find_one_and_update(
+        {'ticket_id': ticket_id}, {'$set': {'last_seen': now}},
+        return_document=ReturnDocument.AFTER
+        )
+    if ticket is None:
+        return jsonify({'status': 'unknown', 'error': 'Unknown ticket.'}), 404
+
+    # Polling also lets users in if room opened up without anyone noticing,
+    # for example as the host load went down.
+    if ticket['status'] == 'waiting':
+        _admit_waiting()
+        ticket = mongo.db.waiting.find_one({'ticket_id': ticket_id})
+
+    if ticket['status'] == 'admitted':
+        job = None
+        if ticket['job_id'] is not None:
+            _expire_launch_jobs()
+            job = mongo.db.launch_jobs.find_one({'job_id': ticket['job_id']})
+        return jsonify({'status': 'admitted', 'job_id': ticket['job_id'],
+                        'job_status': job['status'] if job else 'queued',
+                        'error': job.get('error') if job else None})
+
+    position = mongo.db.waiting.count_documents(
+        {'status': 'waiting', 'date': {'$lt': ticket['date']},
+         'last_seen': {'$gt': now - timedelta(seconds=QUEUE_ABANDON)}}
+        ) + 1
+    return jsonify({'status': 'waiting', 'position': position,
+                    'estimated_wait': _estimate_wait(position)})
+
+
+@app.route('/launch_status/<job_id>', methods=['GET'])
+def launch_status(job_id):
+    _expire_launch_jobs()
+    job = mongo.db.launch_jobs.find_one({'job_id': job_id}, {'_id': False})
+    if job is None:
+        return jsonify({'status': 'unknown', 'error': 'Unknown job.'}), 404
+    job['date'] = job['date'].strftime(TIME_FMT)
+    job.pop('deadline', None)
+    return jsonify(job)
+
+
+@app.route('/session_status/<cont_id>', methods=['GET'])
+def session_status(cont_id):
+    data = _get_my_container(cont_id)
+    if data is None:
+        return jsonify({'ready': False, 'error': 'Unknown session.'}), 404
+    return jsonify({'ready': _is_session_ready(cont_id, data)})
+
+
+def _update_teardown(cont_id, **fields):
+    fields['updated'] = datetime.utcnow()
+    mongo.db.teardowns.update_one({'cont_id': cont_id}, {'$set': fields})
+
+
+def _claim_stale_teardown(cont_id):
+    """Take over a teardown that no live process seems to be running.
+
+    Returns True if the caller should now run the teardown.
+    """
+    now = datetime.utcnow()
+    stale = now - timedelta(seconds=TEARDOWN_STALE)
+    res = mongo.db.teardowns.update_one(
+        {'cont_id': cont_id,
+         '$or': [{'status': {'$nin': ['queued', 'running']}},
+                 {'updated': {'$lt': stale}},
+                 {'updated': {'$exists': False}}]},
+        {'$set': {'status': 'queued', 'updated': now}}
+        )
+    if res.matched_count:
+        return True
+    try:
+        mongo.db.teardowns.insert_one({'cont_id': cont_id, 'status': 'queued',
+                                       'date': now, 'updated': now})
+    except DuplicateKeyError:
+        # It is being torn down by someone else.
+        return False
+    return True
+
+
+def _begin_teardown(cont_id):
+    """Release a session's slot now and tear it down in the background."""
+    record = _mark_draining(cont_id)
+    if record is None:
+        return False
+    decrement_sessions(record['host'])
+    now = datetime.utcnow()
+    teardown = {'cont_id': cont_id, 'status': 'queued', 'date': now,
+                'updated': now}
+    if not record['warm']:
+        teardown['duration'] = (now - record['date']).total_seconds()
+    mongo.db.teardowns.replace_one({'cont_id': cont_id}, teardown,
+                                   upsert=True)
+    _teardown_executor.submit(_run_teardown, cont_id)
+    logger.info("Queued teardown of %s." % cont_id)
+    _admit_waiting()
+    _fill_pools_async()
+    return True
+
+
+def _run_teardown(cont_id):
+    _update_teardown(cont_id, status='running')
+    try:
+        _stop_container(cont_id)
+    except Exception as e:
+        logger.error("Teardown of %s failed." % cont_id)
+        logger.exception(e)
+        _update_teardown(cont_id, status='failed', error=str(e))
+        return
+    _update_teardown(cont_id, status='done')
+    log_call_stats()
+    return
 
 
-def _stop_container(cont_id, remove_record=True):
-    record = _pop_my_container(cont_id, pop=remove_record)
+def _record_teardown_metrics(timings):
+    for phase in ['collect', 'upload', 'remove']:
+        metrics.observe(mongo.db.metrics, 'cwc_teardown_seconds',
+                        timings[phase], phase=phase)
+    for upload_time in timings['uploads']:
+        metrics.observe(mongo.db.metrics, 's3_upload_seconds', upload_time)
+    metrics.inc(mongo.db.metrics, 'cwc_archive_bytes_total',
+                timings['bytes'])
+    return
+
+
+def _stop_container(cont_id, remove_record=True, collect_logs=True):
+    record = _get_my_container(cont_id)
+    assert record is not None, \
+        "Could not stop container because it is not my own."
+    # The record stays, flagged as draining, until the container and its
+    # ports are gone, so a teardown cut short is resumed on reconcile.
+    if not record['draining'] and _mark_draining(cont_id) is not None:
+        decrement_sessions(record['host'])
+    client = _get_client(record['host'])
+    try:
+        cont = client.containers.get(cont_id)
+    except docker.errors.NotFound:
+        logger.warning("Container %s is already gone." % cont_id)
+    else:
+        logger.info("Got container %s, aka %s." % (cont.id, cont.name))
+        # Warm containers were never used, so there is nothing worth keeping.
+        if collect_logs and not record.get('warm'):
+            timings = {}
+            get_logs_for_container(cont, record['interface'], timings,
+                                   ship_state=record.get('shipped'))
+            start = time.time()
+            cont.stop()
+            cont.remove()
+            timings['remove'] = time.time() - start
+            _record_teardown_metrics(timings)
+        else:
+            cont.remove(force=True)
+        logger.info("Container removed.")
+    release_ports(cont_id)
     if remove_record:
-        assert record is not None, \
-            "Could not remove container because it is not my own."
-    client = docker.from_env()
-    cont = client.containers.get(cont_id)
-    logger.info("Got container %s, aka %s." % (cont.id, cont.name))
-    get_logs_for_container(cont, record['interface'])
-    cont.stop()
-    cont.remove()
-    logger.info("Container removed.")
-    decrement_sessions()
+        _pop_my_container(cont_id)
     return
 
 
-def _run_container(port, expose_port, app_name):
-    num_sessions = increment_sessions()
-    logger.info('We now have %d active sessions' % num_sessions)
-    client = docker.from_env()
-    cont = client.containers.run('cwc-integ:latest',
-                                 '/sw/cwc-integ/startup.sh',
-                                 detach=True,
-                                 ports={('%d/tcp' % expose_port): port})
-    logger.info('Launched container %s exposing port %d via port %d'
-                % (cont, expose_port, port))
-    _add_my_container(cont.id, app_name)
-    return cont.id, cont.name
+def _run_container(expose_port, app_name, warm=False):
+    """Start a container on the least loaded host with room for it."""
+    host = _pick_host()
+    if host is None:
+        raise SessionLimitExceeded()
+    num_sessions = increment_sessions(host)
+    logger.info('We now have %d active sessions on %s' % (num_sessions, host))
+    lease_id = uuid.uuid4().hex
+    try:
+        port = lease_port(host, lease_id)
+        client = _get_client(host)
+        cont = client.containers.run('cwc-integ:latest',
+                                     '/sw/cwc-integ/startup.sh',
+                                     detach=True,
+                                     ports={('%d/tcp' % expose_port): port},
+                                     nano_cpus=int(SESSION_CPUS * 1e9),
+                                     mem_limit='%dm' % SESSION_MEMORY_MB)
+    except BaseException:
+        release_ports(lease_id)
+        decrement_sessions(host)
+        raise
+    transfer_port(lease_id, cont.id)
+    logger.info('Launched %scontainer %s on %s exposing port %d via port %d'
+                % ('warm ' if warm else '', cont, host, expose_port, port))
+    _add_my_container(cont.id, app_name, cont.name, host, port, warm)
+    return cont.id, cont.name, host, port
 
 
 def reset_sessions():
     """Reset all the db sessions."""
     logger.info('Resetting sessions')
-    sessions_json = mongo.db.sessions.find_one()
-    if sessions_json is None:
-        mongo.db.sessions.insert_one({'num_sessions': 0})
-    else:
-        mongo.db.sessions.update_one({}, {'$set': {'num_sessions': 0}})
+    for host in DOCKER_HOSTS:
+        mongo.db.sessions.replace_one({'_id': _sessions_id(host)},
+                                      {'num_sessions': 0}, upsert=True)
 
 
 def cleanup():
@@ -314,9 +1429,10 @@ def cleanup():
     print("| %-76s |" % "Grabbing logs, stopping, and removing all docker containers...")
     print("| %-76s |" % "Please wait, as this may take a while.")
     print("+" + "-"*78 + "+")
-    id_dict = _load_id_dict()
-    num_conts = len(id_dict)
-    for i, (cont_id, start_date) in enumerate(id_dict.items()):
+    records = _list_my_containers()
+    num_conts = len(records)
+    for i, data in enumerate(records):
+        cont_id = data['cont_id']
         try:
             print("(%d/%d) Resolving %s...." % (i+1, num_conts, cont_id))
             _stop_container(cont_id)
@@ -325,19 +1441,170 @@ def cleanup():
             logger.error("Reasion:")
             logger.exception(e)
             logger.info("Continuing...")
+    print("Uploading the logs...")
+    _record_uploads(drain_spool(SPOOL_DRAIN_TIMEOUT))
     print("+" + "-"*78 + "+")
     print("| %-76s |" % "All done! Have a nice day! :)")
     print("+" + "-"*78 + "+")
 
 
+def _forget_container(cont_id):
+    """Drop a container that no longer exists from the registry."""
+    record = _pop_my_container(cont_id)
+    if record is None:
+        return
+    release_ports(cont_id)
+    if not record.get('draining'):
+        decrement_sessions(record['host'])
+    _admit_waiting()
+    _fill_pools_async()
+    return
+
+
+def _handle_container_event(event):
+    cont_id = event['Actor']['ID']
+    action = event['Action']
+    record = _get_my_container(cont_id)
+    # Containers being torn down die as part of that.
+    if record is None or record.get('draining'):
+        return
+    logger.info("Container %s got a %s event." % (cont_id, action))
+    if action == 'destroy':
+        _forget_container(cont_id)
+    elif action == 'oom':
+        # A process in the container ran out of memory, but the container
+        # usually keeps running, and dies separately if it doesn't.
+        logger.warning("A process in %s ran out of memory." % cont_id)
+        metrics.inc(mongo.db.metrics, 'cwc_container_oom_total',
+                    interface=record['interface'])
+    else:
+        # The container stopped, but its logs can still be collected.
+        _begin_teardown(cont_id)
+    return
+
+
+def reconcile_sessions(host):
+    """Bring the registry in line with the containers that exist on a host."""
+    client = _get_client(host)
+    conts = {cont.id: cont for cont in client.containers.list(all=True)}
+    for record in _list_my_containers(host=host):
+        cont_id = record['cont_id']
+        cont = conts.get(cont_id)
+        if cont is None:
+            logger.info("Container %s no longer exists." % cont_id)
+            _forget_container(cont_id)
+        elif record.get('draining'):
+            # Resume the teardown only if the process running it must have
+            # gone away.
+            if _claim_stale_teardown(cont_id):
+                logger.info("Resuming teardown of %s." % cont_id)
+                _teardown_executor.submit(_run_teardown, cont_id)
+        elif cont.status != 'running':
+            logger.info("Container %s is %s." % (cont_id, cont.status))
+            _begin_teardown(cont_id)
+
+    my_ids = {record['cont_id'] for record in _list_my_containers(host=host)}
+    for cont_id, cont in conts.items():
+        if cont_id not in my_ids and cont.status == 'running' \
+                and 'cwc-integ:latest' in cont.image.tags:
+            logger.warning("Container %s (%s) is running but is not in the "
+                           "registry." % (cont_id, cont.name))
+    _recount_sessions(host)
+    reconcile_ports(host)
+    return
+
+
+def _launches_in_flight():
+    """Check whether a container may be starting without being registered."""
+    if _count_pending_launches():
+        return True
+    young = datetime.utcnow() - timedelta(seconds=POOL_RESERVATION_TIMEOUT)
+    return mongo.db.pool_slots.count_documents(
+        {'cont_id': None, 'date': {'$gt': young}}, limit=1
+        ) > 0
+
+
+def _recount_sessions(host):
+    """Set a host's session count from the containers registered on it.
+
+    Draining containers have already given up their slots. While launches
+    are in flight, the count is not lowered, as it may include containers
+    that have been counted but not yet registered.
+    """
+    count = mongo.db.containers.count_documents({'host': host,
+                                                 'draining': False})
+    old = mongo.db.sessions.find_one({'_id': _sessions_id(host)})
+    if old is None:
+        mongo.db.sessions.update_one({'_id': _sessions_id(host)},
+                                     {'$set': {'num_sessions': count}},
+                                     upsert=True)
+    elif old['num_sessions'] == count:
+        return
+    elif old['num_sessions'] > count and _launches_in_flight():
+        logger.info("Not lowering the session count on %s while launches "
+                    "are in flight." % host)
+        return
+    else:
+        # Leave it be if it changed since it was read.
+        res = mongo.db.sessions.update_one(
+            {'_id': _sessions_id(host),
+             'num_sessions': old['num_sessions']},
+            {'$set': {'num_sessions': count}}
+            )
+        if not res.modified_count:
+            return
+    logger.info("Set the session count on %s to %d." % (host, count))
+    return
+
+
+def watch_events(host):
+    """Reclaim sessions as soon as a host reports their containers ended."""
+    while True:
+        try:
+            client = _get_client(host)
+            events = client.events(decode=True,
+                                    filters={'type': 'container',
+                                             'event': ['die', 'oom',
+                                                       'destroy']})
+            # Anything that happened while we weren't listening is caught up
+            # on by reconciling after subscribing.
+            reconcile_sessions(host)
+            for event in events:
+                try:
+                    _handle_container_event(event)
+                except Exception as e:
+                    logger.error("Failed to handle event: %s" % event)
+                    logger.exception(e)
+        except Exception as e:
+            logger.error("Lost the docker event stream from %s, "
+                         "reconnecting..." % host)
+            logger.exception(e)
+            time.sleep(10)
+    return
+
+
 def monitor():
     """Check session timers and clean up old session periodically."""
     logger.info("Monitor starting.")
     try:
+        for host in DOCKER_HOSTS:
+            th = threading.Thread(target=watch_events, args=(host,),
+                                  daemon=True)
+            th.start()
+        if SHIP_INTERVAL:
+            threading.Thread(target=ship_logs, daemon=True).start()
+        threading.Thread(target=upload_spool, daemon=True).start()
+        _fill_pools()
         while True:
-            time.sleep(60*15)  # every 15 minutes
+            time.sleep(_seconds_to_next_check())
             logger.info("Checking session in monitor...")
+            sweep_start = datetime.utcnow()
             _check_timers()
+            _record_sweep(sweep_start,
+                          (datetime.utcnow() - sweep_start).total_seconds())
+            log_call_stats()
+            _admit_waiting()
+            _fill_pools()
             logger.info("Check complete. Waiting...")
     except BaseException as e:
         logger.info("Monitor is closing with:")
@@ -355,6 +1622,10 @@ if __name__ == '__main__':
         monitor()
     elif argv[1] == 'reset':
         logging.basicConfig(level=logging.INFO, format=LOGGING_FMT)
+        _ensure_indexes()
+        _ensure_ports()
+        reconcile_ports()
         reset_sessions()
+        _fail_unfinished_launches()
     else:
         app.run(host='0.0.0.0')
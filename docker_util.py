@@ -0,0 +1,96 @@
+"""A shared Docker client whose calls to the daemon are timed and counted."""
+import os
+import time
+import docker
+import threading
+
+import logging
+logger = logging.getLogger('docker-util')
+
+# Calls slower than this many seconds are logged as warnings.
+SLOW_CALL = float(os.environ.get('CWC_DOCKER_SLOW_CALL', 5))
+
+_clients = {}
+_clients_lock = threading.Lock()
+_call_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _record_call(name, duration, failed):
+    with _stats_lock:
+        stats = _call_stats.setdefault(name, {'count': 0, 'errors': 0,
+                                              'total_time': 0.0,
+                                              'max_time': 0.0})
+        stats['count'] += 1
+        stats['total_time'] += duration
+        stats['max_time'] = max(stats['max_time'], duration)
+        if failed:
+            stats['errors'] += 1
+    if duration > SLOW_CALL:
+        logger.warning("Docker call %s took %.1f seconds." % (name, duration))
+    return
+
+
+class _TimedAPIClient(object):
+    """Wrap a low-level APIClient to time every public method call.
+
+    All the high-level objects (containers, images, ...) make their requests
+    through the low-level client, so this catches every call to the daemon.
+    Calls that return a stream are only timed until the stream is opened.
+    """
+    def __init__(self, api):
+        self._api = api
+
+    def __getattr__(self, name):
+        attr = getattr(self._api, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def timed_call(*args, **kwargs):
+            start = time.time()
+            failed = True
+            try:
+                ret = attr(*args, **kwargs)
+                failed = False
+            finally:
+                _record_call(name, time.time() - start, failed)
+            return ret
+        return timed_call
+
+
+def get_docker_client(timeout=None, base_url=None):
+    """Get this process's Docker client, creating it on first use.
+
+    Clients are not shared across a fork, so each process gets its own. A
+    separate client is kept for each daemon and each distinct call timeout.
+    If no base_url is given, the daemon is found from the environment.
+    """
+    key = (os.getpid(), base_url, timeout)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            kwargs = {}
+            if timeout is not None:
+                kwargs['timeout'] = timeout
+            if base_url is None:
+                client = docker.from_env(**kwargs)
+            else:
+                client = docker.DockerClient(base_url=base_url, **kwargs)
+            client.api = _TimedAPIClient(client.api)
+            _clients[key] = client
+    return client
+
+
+def get_call_stats():
+    """Get the count, errors, and total and max time of each kind of call."""
+    with _stats_lock:
+        return {name: stats.copy() for name, stats in _call_stats.items()}
+
+
+def log_call_stats():
+    for name, stats in sorted(get_call_stats().items(),
+                              key=lambda item: -item[1]['total_time']):
+        logger.info("%s: %d calls (%d failed), %.1fs total, %.1fs max"
+                    % (name, stats['count'], stats['errors'],
+                       stats['total_time'], stats['max_time']))
+    return
@@ -0,0 +1,96 @@
+"""Time finding the io entries of a log, with and without the pre-filter.
+
+The old path parses every message before checking its sem, the new one
+only parses the messages that pass CwcLogEntry.is_candidate. Both must find
+the same entries.
+
+Usage:
+    python benchmark_io_entries.py <log_dir>
+    python benchmark_io_entries.py --synthetic <num_entries>
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+
+from kqml import KQMLException
+
+from process_logs import CwcLog
+
+
+# Typical messages, roughly in the proportions they appear in real logs,
+# most of which are chatter between the agents.
+SYNTHETIC_MESSAGES = [
+    (20, 'MRA', '(request :sender BA :receiver MRA :reply-with IO-%d '
+                ':content (build-model :description "%s"))'),
+    (20, 'DTDA', '(reply :sender DTDA :in-reply-to IO-%d '
+                 ':content (success :result (%s)))'),
+    (10, 'BA', '(tell :sender BA :content (spoken :what "I heard %d: %s"))'),
+    (5, 'BA', '(tell :sender TEXTTAGGER :content '
+              '(utterance :text "message %d %s"))'),
+    (3, 'BA', '(tell :sender MRA :content '
+              '(display-image :type simulation :path "images/%d-%s.png"))'),
+    (1, 'BA', '(broadcast :sender BA :content '
+              '(tell :content (start-conversation :n %d :note "%s")))'),
+    ]
+
+
+def make_synthetic_log(num_entries, dirname):
+    """Write a log with the given number of entries into a new directory."""
+    log_dir = os.path.join(dirname, 'CLIC-abc123_cwc_integ_def456')
+    os.mkdir(log_dir)
+    weights = [w for w, _, _ in SYNTHETIC_MESSAGES]
+    with open(os.path.join(log_dir, 'log.txt'), 'w') as f:
+        f.write('<LOG TIME="10:00 AM" DATE="01/02/19">\n')
+        for i in range(num_entries):
+            _, partner, fmt = random.choices(SYNTHETIC_MESSAGES, weights)[0]
+            typ = random.choice('SR')
+            other = 'R' if typ == 'S' else 'S'
+            msg = fmt % (i, 'x' * random.randint(10, 2000))
+            f.write('<%s T="%d.%d:00" %s="%s">\n  %s\n</%s>\n'
+                    % (typ, i // 1000, i % 1000, other, partner, msg, typ))
+    return log_dir
+
+
+def get_io_entries_unfiltered(log):
+    """Find the io entries the way it was done before the pre-filter."""
+    io_entries = []
+    for entry in log.iter_entries():
+        try:
+            entry.get_content()
+        except KQMLException:
+            continue
+        if entry.get_sem() is not None:
+            io_entries.append(entry)
+    return io_entries
+
+
+def time_it(func, log_dir):
+    log = CwcLog(log_dir)
+    start = time.time()
+    entries = func(log)
+    return time.time() - start, [(e.time, e.get_sem()) for e in entries]
+
+
+def main():
+    if sys.argv[1] == '--synthetic':
+        tmp_dir = tempfile.mkdtemp()
+        log_dir = make_synthetic_log(int(sys.argv[2]), tmp_dir)
+    else:
+        log_dir = sys.argv[1]
+
+    size = os.path.getsize(os.path.join(log_dir, 'log.txt'))
+    print("Log is %.1f MB." % (size / 2**20))
+    old_time, old_res = time_it(get_io_entries_unfiltered, log_dir)
+    print("Without pre-filter: %.2fs" % old_time)
+    new_time, new_res = time_it(CwcLog.get_io_entries, log_dir)
+    print("With pre-filter: %.2fs" % new_time)
+    assert old_res == new_res, "The pre-filter changed the io entries."
+    print("Found the same %d io entries, %.1fx faster."
+          % (len(new_res), old_time / new_time))
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -1,65 +1,124 @@
 import os
 import re
+import json
+import time
+import uuid
+import threading
 
 import boto3
 import docker
+import shutil
 import tarfile
 from datetime import datetime
-from io import BytesIO
-from indra.util.aws import get_s3_file_tree
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FutureTimeout
+from itertools import chain
 
 import logging
 logger = logging.getLogger('log-getter')
 
+# Where each session's run directories are made, and the bioagents save
+# their images.
+RUN_DIR = '/sw/cwc-integ'
+IMAGES_DIR = RUN_DIR + '/hms/bioagents/bioagents/images'
 
-def c_ls(container, dirname):
-    started = False
-    if container.status != 'running':
-        started = True
-        container.start()
-        container.attach()
+S3_BUCKET = 'cwc-hms'
+S3_PREFIX = 'bob_ec2_logs/'
 
-    res = container.exec_run(['ls', dirname])
-    if started:
-        container.stop()
+# The interface of a container, by the port it exposes, as started by
+# cwc_integ_app.
+INTERFACE_BY_PORT = {'8000/tcp': 'CLIC', '3000/tcp': 'SBGN'}
 
-    return res.output.decode().splitlines()
+# Logs shipped while a session runs are kept in pieces under here, one
+# folder per session, each piece named <path>@<offset>.
+LIVE_PREFIX = S3_PREFIX + 'live/'
 
+# Set to use a local S3 stand-in, e.g. http://localhost:5000.
+S3_ENDPOINT_URL = os.environ.get('CWC_S3_ENDPOINT_URL')
 
-def get_run_logs(cont):
-    dir_conts = c_ls(cont, 'cwc-integ')
+# Archives are uploaded in parts of this many MB (S3 requires at least 5).
+S3_PART_SIZE = int(os.environ.get('CWC_S3_PART_SIZE_MB', 8)) * 2**20
+
+# Unless CWC_SPOOL_ARCHIVES is 0, logs collected at teardown are written to
+# the spool directory, and uploaded from there in the background, up to
+# SPOOL_WORKERS at a time. Failed uploads are retried after a delay that
+# doubles from SPOOL_RETRY_BASE seconds up to SPOOL_RETRY_MAX.
+SPOOL_ARCHIVES = os.environ.get('CWC_SPOOL_ARCHIVES', '1') != '0'
+SPOOL_DIR = os.environ.get('CWC_SPOOL_DIR', 'spool')
+SPOOL_WORKERS = int(os.environ.get('CWC_SPOOL_WORKERS', 4))
+SPOOL_RETRY_BASE = float(os.environ.get('CWC_SPOOL_RETRY_BASE', 10))
+SPOOL_RETRY_MAX = float(os.environ.get('CWC_SPOOL_RETRY_MAX', 3600))
+
+# Partial files left in the spool by a process that died while writing are
+# removed once they have not been touched for this many seconds.
+SPOOL_PART_MAX_AGE = float(os.environ.get('CWC_SPOOL_PART_MAX_AGE', 3600))
+
+# How many archives to download at once when syncing logs from S3. What
+# has been synced is recorded in a manifest file in the sync folder.
+SYNC_WORKERS = int(os.environ.get('CWC_SYNC_WORKERS', 8))
+MANIFEST_NAME = '.sync_manifest.json'
+
+_s3_clients = {}
+_s3_lock = threading.Lock()
+
+# How many logs and archives of a container to collect at once, and how
+# many seconds to give each, from when it starts, before giving up on it.
+LOG_WORKERS = int(os.environ.get('CWC_LOG_WORKERS', 3))
+LOG_TIMEOUT = float(os.environ.get('CWC_LOG_TIMEOUT', 600))
+
+
+class TaskAbandoned(Exception):
+    pass
+
+
+def _list_new_entries(cont, dirname):
+    """List the entries of a directory that were made or changed in a
+    container.
+
+    This reads the changes to the container's filesystem from the daemon,
+    so works just as well on a stopped container without starting it.
+    Entries that came with the image and were never touched are not listed.
+    """
+    dirname = dirname.rstrip('/')
+    names = set()
+    for change in cont.diff() or []:
+        if change['Kind'] == 2:  # Deleted
+            continue
+        parent, name = os.path.split(change['Path'])
+        if parent == dirname:
+            names.add(name)
+    return sorted(names)
+
+
+def _open_run_logs(cont):
+    """Open the archive of the latest run directory in the container.
+
+    Returns the archive name and a generator of its chunks, or None if the
+    container has no run directory.
+    """
+    dir_conts = _list_new_entries(cont, RUN_DIR)
     possible_results = [p for p in dir_conts if p.startswith('20')]
     if not possible_results:
         return None
     my_result = max(possible_results)
     arch_name = '%s_%s.tar.gz' % (make_cont_name(cont), my_result)
-    with open(arch_name, 'wb') as f:
-        bts, meta = cont.get_archive('/sw/cwc-integ/' + my_result)
-        for bit in bts:
-            f.write(bit)
-    return arch_name
+    bts, meta = cont.get_archive(RUN_DIR + '/' + my_result)
+    return arch_name, bts
 
 
-def get_session_logs(cont):
+def _open_session_logs(cont):
     fname = '%s_%s.log' % (make_cont_name(cont), format_cont_date(cont))
-    with open(fname, 'wb') as f:
-        f.write(cont.logs())
-    return fname
+    return fname, cont.logs(stream=True, follow=False)
 
 
-def get_bioagent_images(cont):
+def _open_bioagent_images(cont):
     try:
-        bts, meta = cont.get_archive(
-            '/sw/cwc-integ/hms/bioagents/bioagents/images'
-            )
+        bts, meta = cont.get_archive(IMAGES_DIR)
     except Exception as e:
         logger.warning("Failed to get images from the bioagents.")
         return None
     arch_name = '%s_bioagent_images.tar.gz' % make_cont_name(cont)
-    with open(arch_name, 'wb') as f:
-        for bit in bts:
-            f.write(bit)
-    return arch_name
+    return arch_name, bts
 
 
 def format_cont_date(cont):
@@ -76,38 +135,473 @@ def make_cont_name(cont):
     return '%s_%s_%s' % (img_id, cont.attrs['Id'][:12], cont.name)
 
 
-def get_logs_for_container(cont, interface):
-    tasks = [get_session_logs, get_run_logs, get_bioagent_images]
-    fnames = []
-    for task in tasks:
-        # Get the logs.
-        fname = task(cont)
+def _live_dir(cont, interface):
+    return '%s%s-%s/' % (LIVE_PREFIX, interface, make_cont_name(cont))
+
+
+def _list_live_files(cont):
+    """Get the size of each file to ship from a running container.
+
+    The files are those of the run directories and the bioagents' images,
+    keyed by their path relative to RUN_DIR.
+    """
+    run_dirs = [RUN_DIR + '/' + name
+                for name in _list_new_entries(cont, RUN_DIR)
+                if name.startswith('20')]
+    res = cont.exec_run(['find'] + run_dirs
+                        + [IMAGES_DIR, '-type', 'f', '-printf', '%s %p\n'],
+                        stderr=False)
+    sizes = {}
+    for line in res.output.decode('utf-8', 'replace').splitlines():
+        size, path = line.split(' ', 1)
+        sizes[os.path.relpath(path, RUN_DIR)] = int(size)
+    return sizes
+
+
+def _ship_piece(chunks, key, timings, spool=False):
+    """Upload or spool a piece, unless it turns out to be empty."""
+    chunks = iter(chunks)
+    for first in chunks:
+        if first:
+            break
+    else:
+        return 0
+    chunks = chain([first], chunks)
+    if spool:
+        return spool_artifact(key, chunks)
+    start = time.time()
+    num_bytes = _stream_to_s3(chunks, key)
+    upload_time = time.time() - start
+    timings['upload'] += upload_time
+    timings['uploads'].append(upload_time)
+    timings['bytes'] += num_bytes
+    return num_bytes
+
+
+def ship_new_logs(cont, interface, state, timings=None, spool=False):
+    """Upload what a running session has logged since it was last shipped.
+
+    The session's stdout since the last call is uploaded as one piece, and
+    the bytes appended to each of its files as another, under the session's
+    folder in LIVE_PREFIX. The state dict records how far each has been
+    shipped, and is updated in place: the caller should keep it and pass it
+    back in next time. Empty pieces are skipped. If spool is True, the
+    pieces are put in the spool to be uploaded later. If a timings dict is given, it is filled in as by
+    get_logs_for_container.
+
+    Returns the number of bytes shipped.
+    """
+    if timings is None:
+        timings = {}
+    for key in ['collect', 'upload', 'bytes']:
+        timings.setdefault(key, 0)
+    timings.setdefault('uploads', [])
+    live_dir = _live_dir(cont, interface)
+    shipped = 0
+
+    # Ship the session's stdout, piece by piece in time.
+    since = state.get('stdout_since', 0)
+    until = int(time.time())
+    if until > since:
+        chunks = cont.logs(since=since, until=until, stream=True,
+                           follow=False)
+        shipped += _ship_piece(chunks, '%sstdout@%d' % (live_dir, since),
+                               timings, spool)
+        state['stdout_since'] = until
+
+    # Ship whatever has been added to the end of each file. A file that
+    # shrank has been rewritten, and is shipped again from the start.
+    # Offsets are stored as pairs, as file names may contain dots.
+    offsets = dict(state.get('files', []))
+    for path, size in sorted(_list_live_files(cont).items()):
+        offset = offsets.get(path, 0)
+        if size < offset:
+            offset = 0
+        elif size == offset:
+            continue
+        res = cont.exec_run(['tail', '-c', '+%d' % (offset + 1),
+                             RUN_DIR + '/' + path],
+                            stderr=False, stream=True)
+        num_bytes = _ship_piece(res.output, '%s%s@%d'
+                                % (live_dir, path, offset), timings, spool)
+        offsets[path] = offset + num_bytes
+        shipped += num_bytes
+    state['files'] = sorted(offsets.items())
+    return shipped
+
+
+def _watch_chunks(chunks, task):
+    """Pass on chunks until the task is abandoned.
+
+    Once every chunk has been passed on, the task is finishing, and can no
+    longer be abandoned.
+    """
+    for chunk in chunks:
+        if task['abandoned']:
+            raise TaskAbandoned()
+        yield chunk
+    with task['lock']:
+        if task['abandoned']:
+            raise TaskAbandoned()
+        task['finishing'] = True
+
+
+def _wait_for_task(future, task):
+    """Wait for a collection task until LOG_TIMEOUT seconds after it began.
+
+    A task still waiting for a worker is waited on until it starts. If it
+    times out, it is abandoned, so it stops at its next chunk, and its
+    partial upload or spool file is thrown away, and FutureTimeout raised.
+    """
+    while True:
+        with task['lock']:
+            if task['finishing']:
+                break
+            if task['start'] is not None:
+                wait = task['start'] + LOG_TIMEOUT - time.time()
+                if wait <= 0:
+                    task['abandoned'] = True
+                    raise FutureTimeout()
+            else:
+                wait = 1
+        try:
+            return future.result(min(wait, 1))
+        except FutureTimeout:
+            continue
+    return future.result()
+
+
+def _collect_one(cont, interface, source, spool, task):
+    """Collect one log or archive from a container and upload or spool it.
+
+    Returns the name it was saved under, or None if it could not be found,
+    along with the time spent collecting and uploading it, and the size
+    uploaded. The task records when it started, and is checked between
+    chunks to see if it has been abandoned.
+    """
+    stats = {'collect': 0, 'upload': 0, 'bytes': 0}
 
-        # Rename the log file. This is a little hacky, but it should work.
-        new_fname = interface + '-' + fname
-        os.rename(fname, new_fname)
-        fname = new_fname
+    # Get the logs.
+    start = time.time()
+    with task['lock']:
+        task['start'] = start
+    res = source(cont)
+    if res is None:
+        stats['collect'] = time.time() - start
+        return None, stats
+    fname, chunks = res
+    chunks = _watch_chunks(chunks, task)
+    fname = interface + '-' + fname
+    if spool:
+        spool_artifact(S3_PREFIX + fname, chunks)
+        logger.info("Spooled %s." % fname)
+        stats['collect'] = time.time() - start
+        return fname, stats
+    stats['collect'] = time.time() - start
 
-        # Add the file to s3.
-        logger.info("Saved %s locally." % fname)
+    # Add the file to s3.
+    start = time.time()
+    stats['bytes'] = _stream_to_s3(chunks, S3_PREFIX + fname)
+    logger.info("%s streamed to s3." % fname)
+    stats['upload'] = time.time() - start
+    return fname, stats
+
+
+def get_logs_for_container(cont, interface, timings=None,
+                           spool=SPOOL_ARCHIVES, ship_state=None):
+    """Collect the logs of a container and upload them to S3.
+
+    The session log, run archive, and image archive are collected by up to
+    LOG_WORKERS threads, each given LOG_TIMEOUT seconds from when it starts,
+    and spooled, or streamed straight to S3 if spool is False. If the
+    session was shipped as it ran, and is still running, only its session
+    log is collected, after shipping what its files gained since.
+
+    If a timings dict is given, the time spent collecting and uploading,
+    the bytes uploaded, and the time of each upload are added to it.
+
+    Returns the names of the session log, run archive, and image archive,
+    with None for any that could not be found or uploaded.
+    """
+    if timings is None:
+        timings = {}
+    for key in ['collect', 'upload', 'bytes']:
+        timings.setdefault(key, 0)
+    timings.setdefault('uploads', [])
+    sources = [_open_session_logs, _open_run_logs, _open_bioagent_images]
+    if ship_state is not None:
+        cont.reload()
+        if cont.status == 'running':
+            ship_new_logs(cont, interface, ship_state, timings, spool)
+            # The stdout pieces are not joined, so keep the whole log too.
+            sources = sources[:1]
+        else:
+            logger.warning("%s stopped before its logs were all shipped, "
+                           "collecting them in bulk." % cont.name)
+    executor = ThreadPoolExecutor(max_workers=LOG_WORKERS)
+    tasks = [{'start': None, 'abandoned': False, 'finishing': False,
+              'lock': threading.Lock()} for _ in sources]
+    futures = [executor.submit(_collect_one, cont, interface, source, spool,
+                               task)
+               for source, task in zip(sources, tasks)]
+    fnames = []
+    for source, task, future in zip(sources, tasks, futures):
+        try:
+            fname, stats = _wait_for_task(future, task)
+        except FutureTimeout:
+            logger.error("Timed out getting %s from %s."
+                         % (source.__name__, cont.name))
+            fnames.append(None)
+            continue
+        except Exception:
+            logger.exception("Failed to get %s from %s."
+                             % (source.__name__, cont.name))
+            fnames.append(None)
+            continue
+        timings['collect'] += stats['collect']
+        if fname is not None and not spool:
+            timings['upload'] += stats['upload']
+            timings['uploads'].append(stats['upload'])
+            timings['bytes'] += stats['bytes']
         fnames.append(fname)
-        _dump_on_s3(fname)
-    return tuple(fnames)
 
+    # Don't wait on any tasks that timed out, they stop on their own.
+    executor.shutdown(wait=False)
+    # Files that were shipped in pieces have no archive.
+    return tuple(fnames) + (None,) * (3 - len(fnames))
 
-def _dump_on_s3(fname):
-    s3 = boto3.client('s3')
-    s3_bucket = 'cwc-hms'
-    s3_prefix = 'bob_ec2_logs/'
-    if not fname:
-        return
+
+def _get_s3_client():
+    """Get this process's S3 client, creating it on first use."""
+    key = (os.getpid(), S3_ENDPOINT_URL)
+    with _s3_lock:
+        client = _s3_clients.get(key)
+        if client is None:
+            client = boto3.client('s3', endpoint_url=S3_ENDPOINT_URL)
+            _s3_clients[key] = client
+    return client
+
+
+def _iter_parts(chunks, part_size):
+    """Regroup a stream of chunks into parts of at least part_size bytes.
+
+    The last part may be smaller.
+    """
+    buf = bytearray()
+    for chunk in chunks:
+        buf.extend(chunk)
+        while len(buf) >= part_size:
+            yield bytes(buf[:part_size])
+            del buf[:part_size]
+    if buf:
+        yield bytes(buf)
+
+
+def _stream_to_s3(chunks, key):
+    """Upload a stream of chunks to S3, holding at most one part in memory.
+
+    Returns the number of bytes uploaded.
+    """
+    s3 = _get_s3_client()
+    parts = _iter_parts(chunks, S3_PART_SIZE)
+    first = next(parts, b'')
+    second = next(parts, None)
+    if second is None:
+        # Small enough for a single request.
+        s3.put_object(Key=key, Body=first, Bucket=S3_BUCKET)
+        return len(first)
+
+    upload_id = s3.create_multipart_upload(Bucket=S3_BUCKET,
+                                           Key=key)['UploadId']
+    num_bytes = 0
+    part_tags = []
+    try:
+        for part_num, part in enumerate(chain([first, second], parts), 1):
+            res = s3.upload_part(Bucket=S3_BUCKET, Key=key, Body=part,
+                                 PartNumber=part_num, UploadId=upload_id)
+            part_tags.append({'ETag': res['ETag'], 'PartNumber': part_num})
+            num_bytes += len(part)
+        s3.complete_multipart_upload(Bucket=S3_BUCKET, Key=key,
+                                     UploadId=upload_id,
+                                     MultipartUpload={'Parts': part_tags})
+    except BaseException:
+        s3.abort_multipart_upload(Bucket=S3_BUCKET, Key=key,
+                                  UploadId=upload_id)
+        raise
+    return num_bytes
+
+
+def _iter_file(fname, chunk_size):
     with open(fname, 'rb') as f:
-        s3.put_object(Key=s3_prefix + fname, Body=f.read(),
-                      Bucket=s3_bucket)
-    logger.info("%s dumped on s3." % fname)
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def _write_spool_meta(name, meta):
+    with open(name + '.tmp', 'w') as f:
+        json.dump(meta, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(name + '.tmp', name + '.json')
+    return
+
+
+def spool_artifact(key, chunks):
+    """Write an artifact to the spool, to be uploaded to S3 under key.
+
+    The uploader only sees the artifact once it has been written in full,
+    and it stays in the spool, across restarts, until it is uploaded. If
+    writing it fails, the partial file is removed. Returns its size.
+    """
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    name = os.path.join(SPOOL_DIR, uuid.uuid4().hex)
+    num_bytes = 0
+    try:
+        with open(name + '.part', 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                num_bytes += len(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        os.remove(name + '.part')
+        raise
+    os.replace(name + '.part', name + '.data')
+    _write_spool_meta(name, {'key': key, 'size': num_bytes, 'attempts': 0,
+                             'next_try': 0})
+    return num_bytes
+
+
+def _list_spooled():
+    """Get the name and metadata of each artifact in the spool."""
+    if not os.path.exists(SPOOL_DIR):
+        return []
+    spooled = []
+    for fname in sorted(os.listdir(SPOOL_DIR)):
+        if not fname.endswith('.json'):
+            continue
+        name = os.path.join(SPOOL_DIR, fname[:-len('.json')])
+        try:
+            with open(name + '.json') as f:
+                spooled.append((name, json.load(f)))
+        except (IOError, ValueError):
+            logger.warning("Could not read %s.json, skipping it." % name)
+    return spooled
+
+
+def _sweep_spool():
+    """Remove partial files left in the spool by writers that died.
+
+    These are .part files, and .data files that never got their metadata,
+    that have not been touched for SPOOL_PART_MAX_AGE seconds.
+    """
+    if not os.path.exists(SPOOL_DIR):
+        return
+    cutoff = time.time() - SPOOL_PART_MAX_AGE
+    fnames = set(os.listdir(SPOOL_DIR))
+    for fname in fnames:
+        name, ext = os.path.splitext(fname)
+        if ext == '.data' and name + '.json' in fnames:
+            continue
+        if ext not in ['.part', '.data', '.tmp']:
+            continue
+        path = os.path.join(SPOOL_DIR, fname)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                logger.warning("Removed stale %s from the spool." % fname)
+        except OSError:
+            # Finished or removed since it was listed.
+            continue
     return
 
 
+def _upload_spooled(name, meta):
+    """Upload a spooled artifact, and remove it once uploaded.
+
+    Returns the time the upload took and its size, or None if it failed,
+    in which case it is left to be tried again later.
+    """
+    start = time.time()
+    try:
+        num_bytes = _stream_to_s3(_iter_file(name + '.data', S3_PART_SIZE),
+                                  meta['key'])
+    except Exception as e:
+        meta['attempts'] += 1
+        delay = min(SPOOL_RETRY_BASE * 2**(meta['attempts'] - 1),
+                    SPOOL_RETRY_MAX)
+        meta['next_try'] = time.time() + delay
+        logger.warning("Upload %d of %s failed, retrying in %ds: %s"
+                       % (meta['attempts'], meta['key'], delay, e))
+        _write_spool_meta(name, meta)
+        return None
+    upload_time = time.time() - start
+    # Once the metadata is gone, the data is no longer seen as spooled.
+    os.remove(name + '.json')
+    os.remove(name + '.data')
+    logger.info("%s dumped on s3." % meta['key'])
+    return upload_time, num_bytes
+
+
+def upload_spooled():
+    """Upload every spooled artifact that is due, SPOOL_WORKERS at a time.
+
+    Only one process should upload from a spool at a time. Returns the time
+    taken by each successful upload and its size. Partial files left by
+    writers that died are swept up first.
+    """
+    _sweep_spool()
+    now = time.time()
+    due = [(name, meta) for name, meta in _list_spooled()
+           if meta['next_try'] <= now]
+    if not due:
+        return []
+    with ThreadPoolExecutor(max_workers=SPOOL_WORKERS) as executor:
+        results = list(executor.map(lambda args: _upload_spooled(*args),
+                                    due))
+    return [res for res in results if res is not None]
+
+
+def count_spooled():
+    """Get the number of artifacts waiting in the spool."""
+    return len(_list_spooled())
+
+
+def drain_spool(timeout=None):
+    """Upload everything in the spool, waiting out retries.
+
+    Gives up after timeout seconds, if given, leaving the rest in the spool.
+    Returns the time taken by each successful upload and its size.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    results = []
+    while True:
+        results += upload_spooled()
+        spooled = _list_spooled()
+        if not spooled:
+            break
+        wait = max(min(meta['next_try'] for _, meta in spooled)
+                   - time.time(), 0)
+        if deadline is not None and time.time() + wait > deadline:
+            logger.warning("%d artifacts are left in the spool."
+                           % len(spooled))
+            break
+        time.sleep(wait)
+    return results
+
+
+def _guess_interface(cont):
+    """Tell the interface of a container from the port it exposes."""
+    ports = cont.attrs['HostConfig'].get('PortBindings') or {}
+    for port, interface in INTERFACE_BY_PORT.items():
+        if port in ports:
+            return interface
+    return 'UNKNOWN'
+
+
 def get_logs():
     """Get logs from local Docker instances and upload them to S3."""
     client = docker.from_env()
@@ -116,7 +610,9 @@ def get_logs():
     log_arches = []
     img_arches = []
     for cont in cont_list:
-        ses_name, run_name, img_name = get_logs_for_container(cont)
+        ses_name, run_name, img_name = \
+            get_logs_for_container(cont, _guess_interface(cont),
+                                   ship_state=None)
         master_logs.append(ses_name)
         log_arches.append(run_name)
         img_arches.append(img_name)
@@ -124,68 +620,290 @@ def get_logs():
     print(master_logs)
     print(log_arches)
     print(img_arches)
+    drain_spool()
     return
 
 
-def get_logs_from_s3(folder=None, cached=True):
-    """Download logs from S3 and save into a local folder"""
-    import tqdm
+def _list_s3_objects(s3, prefix):
+    """Page through all the objects under a prefix."""
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            yield obj
+
+
+def _sync_archive(s3, key, head_dir_path, resource_name):
+    """Download an archive and extract what we want from it as it streams.
+
+    Returns a short description of the result.
+    """
+    body = s3.get_object(Bucket=S3_BUCKET, Key=key)['Body']
+    try:
+        with tarfile.open(None, 'r|*', fileobj=body) as tarf:
+            if resource_name == 'bioagent_images':
+                tarf.extractall(head_dir_path)
+                return 'extracted'
+
+            # Only the first facilitator log is kept.
+            for member in tarf:
+                if member.name.endswith('facilitator.log'):
+                    break
+            else:
+                return 'no facilitator.log'
+            outpath = os.path.join(head_dir_path, 'log.txt')
+            with open(outpath + '.part', 'wb') as fh:
+                shutil.copyfileobj(tarf.extractfile(member), fh)
+            os.replace(outpath + '.part', outpath)
+            return 'extracted'
+    finally:
+        body.close()
+
+
+def _load_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_manifest(path, manifest):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+    return
+
+
+def _is_synced(manifest, obj):
+    """Check whether an object was synced as it is now, without failing."""
+    entry = manifest.get(obj['Key'])
+    return (entry is not None and entry['etag'] == obj['ETag']
+            and entry['size'] == obj['Size']
+            and not entry['result'].startswith('failed'))
+
+
+def _record_synced(manifest, obj, result):
+    manifest[obj['Key']] = {'etag': obj['ETag'], 'size': obj['Size'],
+                            'result': result}
+    return
+
+
+def get_logs_from_s3(folder=None, cached=True, report=None):
+    """Download logs from S3 and save into a local folder.
 
-    # TODO: We are going to have to page through s3 logs. We can only get at
-    # most 1000 items. I wrote something to handle this here:
-    # https://github.com/indralab/indra_db/blob/a32132a2a8ecb10fea07666abafbffb50dd77679/indra_db/reading/submit_reading_pipeline.py#L193-L204
-    s3 = boto3.client('s3')
-    tree = get_s3_file_tree(s3, 'cwc-hms', 'bob_ec2_logs')
-    keys = tree.gets('key')
+    All the keys are paged through, and the archives downloaded by up to
+    SYNC_WORKERS threads, each streamed straight into tarfile. If cached,
+    objects whose ETag and size match those in the folder's manifest from
+    an earlier sync are skipped, as are run archives not in the manifest
+    whose log.txt is already there. Any whose ETag or size has changed are
+    synced again. Pieces shipped while a session ran are
+    joined only where its archives could not be synced. If a report dict is
+    given, it is filled with the result for each key.
+    """
+    if report is None:
+        report = {}
+    manifest_path = os.path.join(folder or '.', MANIFEST_NAME)
+    manifest = _load_manifest(manifest_path)
+    s3 = _get_s3_client()
+    objs = {obj['Key']: obj for obj in _list_s3_objects(s3, S3_PREFIX)}
     # Here we only get the tar.gz files which contain the logs for the
     # facilitator
-    print(len(keys))
-    print(len([k for k in keys if 'image' in k]))
-    keys = [key for key in keys if key.startswith('bob_ec2_logs/')
-            and key.endswith('.tar.gz')]
-    print(len(keys))
+    keys = sorted(key for key in objs if key.endswith('.tar.gz'))
     print('Found %d keys' % len(keys))
 
+    dir_set = set()
+    try:
+        bulk = _sync_archives(s3, keys, objs, folder, cached, manifest,
+                              report, dir_set)
+        dir_set |= _get_live_logs(s3, objs, folder, cached, manifest,
+                                  report, bulk)
+    finally:
+        _save_manifest(manifest_path, manifest)
+    counts = {}
+    for result in report.values():
+        result = result.split(':')[0]
+        counts[result] = counts.get(result, 0) + 1
+    summary = ', '.join('%d %s' % (n, result)
+                        for result, n in sorted(counts.items()))
+    logger.info("Synced logs: %s" % summary)
+    return dir_set
+
+
+def _sync_archives(s3, keys, objs, folder, cached, manifest, report,
+                   dir_set):
+    """Download and extract the archives that are new or have changed.
+
+    Returns which archives each session folder has in full, 'run' for its
+    facilitator log and 'images' for its images, so the pieces shipped
+    while it ran are not joined over them.
+    """
+    import tqdm
+
     fname_patt = re.compile('([\w:-]+?)_(\w+?)_(\w+?_\w+?)_(.*).tar.gz')
+    futures = {}
+    kinds = {}
+    with ThreadPoolExecutor(max_workers=SYNC_WORKERS) as executor:
+        for key in keys:
+            fname = os.path.basename(key)
+            m = fname_patt.match(fname)
+            if m is None:
+                logger.warning("File name %s failed to match %s. Skipping..."
+                               % (fname, fname_patt))
+                report[key] = 'bad name'
+                continue
+            image_id, cont_hash, cont_name, resource_name = m.groups()
+            head_dir_path = '%s_%s_%s' % (image_id.replace(':', '-'),
+                                          cont_name, cont_hash)
+            dir_set.add(head_dir_path)
+            kinds[key] = (head_dir_path, 'images'
+                          if resource_name == 'bioagent_images' else 'run')
+            if folder:
+                head_dir_path = os.path.join(folder, head_dir_path)
+            os.makedirs(head_dir_path, exist_ok=True)
+            has_log = os.path.exists(os.path.join(head_dir_path, 'log.txt'))
+            if cached and _is_synced(manifest, objs[key]) \
+                    and (resource_name == 'bioagent_images' or has_log
+                         or manifest[key]['result'] == 'no facilitator.log'):
+                report[key] = 'unchanged'
+                continue
+            # A log from before the manifest was kept is trusted, but one
+            # whose archive has changed since it was synced is not.
+            if resource_name != 'bioagent_images' and cached and has_log \
+                    and key not in manifest:
+                report[key] = 'cached'
+                _record_synced(manifest, objs[key], report[key])
+                continue
+            futures[executor.submit(_sync_archive, s3, key, head_dir_path,
+                                    resource_name)] = key
+
+        for future in tqdm.tqdm(as_completed(futures), total=len(futures)):
+            key = futures[future]
+            try:
+                report[key] = future.result()
+            except Exception as e:
+                report[key] = 'failed: %s' % e
+                logger.error("Failed to sync %s: %s" % (key, e))
+            _record_synced(manifest, objs[key], report[key])
+            if report[key] == 'no facilitator.log':
+                tqdm.tqdm.write('No facilitator.log found for %s' % key)
+
+    bulk = {}
+    for key, (head_dir_path, kind) in kinds.items():
+        result = manifest[key]['result']
+        if result.startswith('failed') or result == 'no facilitator.log':
+            continue
+        bulk.setdefault(head_dir_path, set()).add(kind)
+    return bulk
+
+
+def _join_pieces(s3, pieces, outpath):
+    """Join the pieces of a shipped file, given as (offset, key) pairs."""
+    length = 0
+    with open(outpath, 'wb') as f:
+        for offset, key in sorted(pieces):
+            if offset > length:
+                logger.warning("Missing bytes %d to %d of %s."
+                               % (length, offset, outpath))
+            body = s3.get_object(Bucket=S3_BUCKET, Key=key)['Body'].read()
+            # A piece may overlap the last if it was shipped twice.
+            f.write(body[max(length - offset, 0):])
+            length = max(length, offset + len(body))
+    return
+
+
+def _sync_live_file(s3, pieces, outpath, objs, cached, manifest, report):
+    """Join the pieces of a file, unless none have changed since the last
+    sync."""
+    if cached and os.path.exists(outpath) \
+            and all(_is_synced(manifest, objs[key]) for _, key in pieces):
+        for _, key in pieces:
+            report[key] = 'unchanged'
+        return
+    try:
+        _join_pieces(s3, pieces, outpath)
+        result = 'joined'
+    except Exception as e:
+        result = 'failed: %s' % e
+        logger.error("Failed to join %s: %s" % (outpath, e))
+    for _, key in pieces:
+        report[key] = result
+        _record_synced(manifest, objs[key], result)
+    return
+
+
+def _supersede(files, paths, report):
+    """Report the pieces of files covered by a synced archive."""
+    for path in paths:
+        for _, key in files[path]:
+            report[key] = 'superseded'
+    return
+
+
+def _get_live_logs(s3, objs, folder=None, cached=True, manifest=None,
+                   report=None, bulk=None):
+    """Reassemble the logs shipped while sessions ran, like the archives.
+
+    Where bulk says a session's run or images archive was synced, it is
+    complete, so the pieces it covers are reported as superseded rather
+    than joined over it.
+    """
+    if manifest is None:
+        manifest = {}
+    if report is None:
+        report = {}
+    if bulk is None:
+        bulk = {}
+    session_patt = re.compile('([\w:-]+?)_(\w+?)_(\w+?_\w+?)$')
+    images_path = os.path.relpath(IMAGES_DIR, RUN_DIR)
+    sessions = {}
+    for key in objs:
+        if not key.startswith(LIVE_PREFIX):
+            continue
+        session, piece = key[len(LIVE_PREFIX):].split('/', 1)
+        path, offset = piece.rsplit('@', 1)
+        sessions.setdefault(session, {}).setdefault(path, []) \
+            .append((int(offset), key))
+
     dir_set = set()
-    for key in tqdm.tqdm(keys):
-        fname = os.path.basename(key)
-        m = fname_patt.match(fname)
+    for session, files in sessions.items():
+        m = session_patt.match(session)
         if m is None:
-            logger.warning("File name %s failed to match %s. Skipping..."
-                           % (fname, fname_patt))
+            logger.warning("Session %s failed to match %s. Skipping..."
+                           % (session, session_patt))
             continue
-        image_id, cont_hash, cont_name, resource_name = m.groups()
+        image_id, cont_hash, cont_name = m.groups()
         head_dir_path = '%s_%s_%s' % (image_id.replace(':', '-'), cont_name,
                                       cont_hash)
         dir_set.add(head_dir_path)
+        in_bulk = bulk.get(head_dir_path, set())
         if folder:
             head_dir_path = os.path.join(folder, head_dir_path)
         if not os.path.exists(head_dir_path):
             os.mkdir(head_dir_path)
-        if resource_name == 'bioagent_images':
-            outpath = head_dir_path
+
+        # Take the facilitator log of the latest run.
+        facls = sorted(path for path in files if path.startswith('20')
+                       and path.endswith('facilitator.log'))
+        outpath = os.path.join(head_dir_path, 'log.txt')
+        if 'run' in in_bulk:
+            _supersede(files, facls, report)
+        elif not facls:
+            print('No facilitator.log found for %s' % session)
         else:
-            outpath = os.path.join(head_dir_path, 'log.txt')
-            if cached and os.path.exists(outpath):
-                continue
+            _sync_live_file(s3, files[facls[-1]], outpath, objs, cached,
+                            manifest, report)
 
-        res = s3.get_object(Bucket='cwc-hms', Key=key)
-        byte_stream = BytesIO(res['Body'].read())
-        with tarfile.open(None, 'r', fileobj=byte_stream) as tarf:
-            if resource_name == 'bioagent_images':
-                tarf.extractall(outpath)
-            else:
-                outpaths = tarf.getnames()
-                facls = [n for n in outpaths if n.endswith('facilitator.log')]
-                if not facls:
-                    print('No facilitator.log found for %s' % key)
-                    continue
-                facl = facls[0]
-                efo = tarf.extractfile(facl)
-                log_txt = efo.read().decode('utf-8')
-                with open(outpath, 'w') as fh:
-                    fh.write(log_txt)
+        images = [path for path in files
+                  if path.startswith(images_path + '/')]
+        if 'images' in in_bulk:
+            _supersede(files, images, report)
+            continue
+        for path in images:
+            pieces = files[path]
+            outpath = os.path.join(head_dir_path, 'images',
+                                   os.path.relpath(path, images_path))
+            os.makedirs(os.path.dirname(outpath), exist_ok=True)
+            _sync_live_file(s3, pieces, outpath, objs, cached, manifest,
+                            report)
     return dir_set
 
 
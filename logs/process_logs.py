@@ -2,6 +2,7 @@ import os
 import re
 import sys
 import json
+import mmap
 import textwrap
 from datetime import datetime
 
@@ -13,6 +14,13 @@ logger = logging.getLogger('log_processor')
 THIS_DIR = os.path.abspath(os.path.dirname(__file__))
 IMG_DIRNAME = 'images'
 
+# Logs are read this many bytes at a time.
+CHUNK_SIZE = 2**20
+
+# The longest the header of a section may be. A header cut off by the end
+# of a chunk is told apart from text that isn't a header by its length.
+MAX_HEADER_LEN = 1024
+
 
 def make_html(html_parts):
     with open(os.path.join(THIS_DIR, 'page_template.html'), 'r') as fh:
@@ -23,20 +31,69 @@ def make_html(html_parts):
 
 
 class CwcLogEntry(object):
-    """Parent class for entries in the logs."""
+    """Parent class for entries in the logs.
+
+    There may be millions of entries in a log, so they are kept small: the
+    message is not copied out of the log, but kept as its offsets in the
+    memory-mapped file, and only decoded when it is asked for.
+    """
+    __slots__ = ('type', 'time', 'partner', 'log_dir', '_message', '_map',
+                 '_start', '_end', 'content', 'sem')
     possible_sems = ('sys_utterance', 'user_utterance', 'display_image',
                      'add_provenance', 'display_sbgn', 'reset')
 
+    # Before parsing a message, it is checked against the heads any sem
+    # needs (see _content_is). Messages with the BA may be any sem, others
+    # can only be one of the simple types.
+    _candidate_patt = re.compile(br'\(\s*tell\s.*?:content\s*\(\s*'
+                                 br'(display-image|display-sbgn|add-provenance)'
+                                 br'\b', re.IGNORECASE | re.DOTALL)
+    _ba_candidate_patt = re.compile(br'\(\s*(tell|broadcast)\s.*?:content'
+                                    br'\s*\(\s*(display-image|display-sbgn|'
+                                    br'add-provenance|spoken|utterance|tell)'
+                                    br'\b', re.IGNORECASE | re.DOTALL)
+
     def __init__(self, type, time, message, partner, log_dir):
         self.type = type
         self.time = time
-        self.message = message
-        self.partner = partner
+        self.partner = sys.intern(partner)
         self.log_dir = log_dir
+        self._message = message
+        self._map = None
+        self._start = self._end = 0
         self.content = None
         self.sem = None
         return
 
+    @classmethod
+    def from_map(cls, type, time, partner, log_dir, log_map, start, end):
+        """Make an entry whose message is at start:end in the mapped log."""
+        entry = cls(type, time, None, partner, log_dir)
+        entry._map = log_map
+        entry._start = start
+        entry._end = end
+        return entry
+
+    @property
+    def message(self):
+        if self._message is not None:
+            return self._message
+        return self._map[self._start:self._end].decode('utf-8', 'replace')
+
+    def is_candidate(self):
+        """Cheaply check whether this entry could have a sem at all.
+
+        This only looks at the raw message, without parsing it, and never
+        rules out an entry that get_sem would find a sem for.
+        """
+        if self.partner.upper() == 'BA':
+            patt = self._ba_candidate_patt
+        else:
+            patt = self._candidate_patt
+        if self._message is not None:
+            return patt.match(self._message.encode('utf-8')) is not None
+        return patt.match(self._map, self._start, self._end) is not None
+
     def get_content(self):
         """Convert the entry to a message."""
         if not self.content:
@@ -183,21 +240,28 @@ class CwcLogEntry(object):
 
 
 class CwcLog(object):
-    """Object to organize the logs retrieved from cwc facilitator.log."""
-    section_patt = re.compile('<(?P<type>S|R)\s+T=\"(?P<time>[\d.:]+)\"\s+'
-                              '(?P<other_type>S|R)=\"(?P<sender>\w+)\">'
-                              '\s+(?P<msg>.*?)\s+</(?P=type)>', re.DOTALL)
-    time_patt = re.compile('<LOG TIME=\"(.*?)\"\s+DATE=\"(.*?)\".*?>')
+    """Object to organize the logs retrieved from cwc facilitator.log.
+
+    The log is memory-mapped, and scanned in chunks as it is needed, so
+    only the entries kept by the caller are held in memory, and those only
+    refer to their messages in the map.
+    """
+    section_patt = re.compile(br'<(?P<type>S|R)\s+T=\"(?P<time>[\d.:]+)\"\s+'
+                              br'(?P<other_type>S|R)=\"(?P<sender>\w+)\">'
+                              br'\s+(?P<msg>.*?)\s+</(?P=type)>', re.DOTALL)
+    section_start_patt = re.compile(br'<(S|R)\s+T=\"')
+    section_head_patt = re.compile(br'<(S|R)\s+T=\"[\d.:]+\"\s+(S|R)=\"\w+\">'
+                                   br'\s+')
+    space_patt = re.compile(br'\s*')
+    time_patt = re.compile(br'<LOG TIME=\"(.*?)\"\s+DATE=\"(.*?)\".*?>')
     container_name_patt = re.compile('([\w-]+)_(\w+?_\w+?)_(\w+)')
 
     def __init__(self, log_dir):
         self.log_dir = log_dir
 
-        # Load and parse the log file.
         self.log_file = os.path.join(log_dir, 'log.txt')
-        with open(self.log_file, 'r') as f:
-            self.__log = f.read()
         self.start_time = None
+        self._map = None
 
         # Parse out information regarding the container from the dirname.
         m = self.container_name_patt.match(os.path.basename(self.log_dir))
@@ -239,38 +303,129 @@ class CwcLog(object):
     def get_start_time(self):
         if self.start_time is None:
             logger.info("Loading start time...")
-            tp = self.time_patt.search(self.__log)
+            tp = self.time_patt.search(self._get_map())
             assert tp is not None, "Failed to get time string."
-            self.start_time = ' '.join(tp.groups())
+            self.start_time = ' '.join(g.decode() for g in tp.groups())
         return self.start_time
 
+    def _get_map(self):
+        """Get the log file mapped into memory, mapping it on first use."""
+        if self._map is None:
+            if os.path.getsize(self.log_file) == 0:
+                # Empty files can't be mapped.
+                self._map = b''
+            else:
+                with open(self.log_file, 'rb') as fh:
+                    self._map = mmap.mmap(fh.fileno(), 0,
+                                          access=mmap.ACCESS_READ)
+        return self._map
+
+    def _is_settled(self, buf, m):
+        """Check that a section matched in part of the data would match the
+        same way in all of it.
+
+        The message is matched lazily after as much space as there is, so
+        if the section could only end by giving some of that space back, or
+        the space runs to the end of what has been read, it may end further
+        on in the rest of the data.
+        """
+        space_end = self.space_patt.match(buf, m.end('sender') + 2).end()
+        return space_end == m.start('msg') and space_end < len(buf)
+
+    def _iter_sections(self, data):
+        """Find the sections of the log, reading it in chunks.
+
+        Yields the offset in data of the chunk each section was found in,
+        and its match of section_patt within the chunk. The sections found
+        are the same as those a findall over all the data would find, but
+        only as much of it is copied at once as the longest section spans.
+        """
+        buf = b''
+        base = 0  # The offset of buf in the data.
+        read_pos = 0
+        pos = 0
+        eof = False
+        while True:
+            start = self.section_start_patt.search(buf, pos)
+            if start is not None:
+                m = self.section_patt.match(buf, start.start())
+                if m is not None and (eof or self._is_settled(buf, m)):
+                    yield base, m
+                    pos = m.end()
+                    continue
+
+                # Either the section doesn't end within what we've read, or
+                # this isn't a section at all.
+                if m is None:
+                    head = self.section_head_patt.match(buf, start.start())
+                    if eof or (head is None and
+                               len(buf) - start.start() > MAX_HEADER_LEN):
+                        pos = start.start() + 1
+                        continue
+                keep = start.start()
+            elif eof:
+                return
+            else:
+                # Keep enough that a start cut off at the end is still found.
+                keep = max(pos, len(buf) - MAX_HEADER_LEN)
+
+            chunk = data[read_pos:read_pos + CHUNK_SIZE]
+            read_pos += len(chunk)
+            eof = not chunk
+            base += keep
+            buf = buf[keep:] + chunk
+            pos = 0
+
+    def iter_entries(self):
+        """Yield the entries of the log, reading it as they are needed."""
+        if self.all_entries is not None:
+            for entry in self.all_entries:
+                yield entry
+            return
+        log_map = self._get_map()
+        for base, m in self._iter_sections(log_map):
+            yield CwcLogEntry.from_map(m.group('type').decode(),
+                                       m.group('time').decode(),
+                                       m.group('sender').decode(),
+                                       self.log_dir, log_map,
+                                       base + m.start('msg'),
+                                       base + m.end('msg'))
+
     def get_all_entries(self):
         if self.all_entries is None:
             logger.info("Loading log entries...")
-            self.all_entries = []
-            sec_list = self.section_patt.findall(self.__log)
-            assert sec_list, "Failed to find any sections."
-            for typ, dt, other_type, partner, msg in sec_list:
-                entry = CwcLogEntry(typ, dt, msg, partner, self.log_dir)
-                self.all_entries.append(entry)
+            all_entries = list(self.iter_entries())
+            assert all_entries, "Failed to find any sections."
+            self.all_entries = all_entries
             logger.info("Found %d log entries." % len(self.all_entries))
         return self.all_entries
 
+    def iter_io_entries(self):
+        """Yield the entries that are part of the dialogue, as they are
+        found."""
+        if self.io_entries is not None:
+            for entry in self.io_entries:
+                yield entry
+            return
+        logger.info("Filtering to io entries...")
+        num_io = 0
+        for entry in self.iter_entries():
+            if not entry.is_candidate():
+                continue
+            try:
+                entry.get_content()
+            except KQMLException:
+                logger.debug("Failed to get content for:\n%s."
+                             % repr(entry))
+                continue
+            if entry.get_sem() is not None:
+                num_io += 1
+                yield entry
+        logger.info("Found %d io entries." % num_io)
+
     def get_io_entries(self):
-        if not self.io_entries:
-            self.io_entries = []
-            entry_list = self.get_all_entries()
-            logger.info("Filtering to io entries...")
-            for entry in entry_list:
-                try:
-                    entry.get_content()
-                except KQMLException:
-                    logger.debug("Failed to get content for:\n%s."
-                                 % repr(entry))
-                    continue
-                if entry.get_sem() is not None:
-                    self.io_entries.append(entry)
-            logger.info("Found %d io entries." % len(self.io_entries))
+        if self.io_entries is None:
+            self.io_entries = list(self.iter_io_entries())
         return self.io_entries
 
     def make_header(self):
@@ -290,7 +445,7 @@ class CwcLog(object):
         html_parts.append(self.make_header())
 
         # Find all messages received by the BA
-        for entry in self.get_io_entries():
+        for entry in self.iter_io_entries():
             html_part = entry.make_html()
             if html_part is not None:
                 html_parts.append(html_part)
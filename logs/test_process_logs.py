@@ -0,0 +1,38 @@
+import random
+
+import process_logs
+from process_logs import CwcLog
+
+
+# Bits of log to build random logs from, including ones that only look like
+# the start or end of a section.
+LOG_BITS = [b'<R T="10.1:00" S="AG1">', b'<S T="11.1:00" R="BA">', b'</R>',
+            b'</S>', b'\n', b'  ', b'hello', b'(tell :content (foo))',
+            b'<R T="', b'<S ...>']
+
+
+def make_log(tmp_path):
+    log_dir = tmp_path / 'CLIC-abc123_cwc_integ_def456'
+    log_dir.mkdir()
+    return CwcLog(str(log_dir))
+
+
+def find_sections(log, data):
+    return [(base + m.start(), base + m.end())
+            for base, m in log._iter_sections(data)]
+
+
+def test_sections_do_not_depend_on_chunks(tmp_path, monkeypatch):
+    log = make_log(tmp_path)
+    rand = random.Random(0)
+    datas = [b'<S ...>\n  x\n</S>\n<R T="10.1:00" S="AG1">\n  \n</R>\n'
+             b'<R T="11.1:00" S="B">\n  hello\n</R>']
+    datas += [b''.join(rand.choice(LOG_BITS)
+                       for _ in range(rand.randint(0, 40)))
+              for _ in range(500)]
+    for data in datas:
+        expected = [(m.start(), m.end())
+                    for m in CwcLog.section_patt.finditer(data)]
+        for chunk_size in [1, 2, 3, 7, rand.randint(1, 64), 2**20]:
+            monkeypatch.setattr(process_logs, 'CHUNK_SIZE', chunk_size)
+            assert find_sections(log, data) == expected, (data, chunk_size)
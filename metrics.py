@@ -0,0 +1,106 @@
+"""Prometheus metrics kept in a Mongo collection.
+
+The web workers and the monitor are separate processes, so rather than
+keeping metrics in memory, every observation is an atomic increment on a
+shared document, and a scrape from any process sees the totals.
+"""
+TIME_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+FAST_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+HISTOGRAMS = {
+    'cwc_launch_seconds':
+        ("Time from a launch request to its container running.",
+         TIME_BUCKETS),
+    'cwc_boot_to_ready_seconds':
+        ("Time from a container starting to its interface responding.",
+         TIME_BUCKETS),
+    'cwc_teardown_seconds':
+        ("Time spent tearing down a session, by phase.", TIME_BUCKETS),
+    's3_upload_seconds':
+        ("Time taken by a single upload of an artifact to S3.",
+         FAST_BUCKETS),
+    }
+
+COUNTERS = {
+    'cwc_archive_bytes_total':
+        "Bytes of logs and archives shipped to S3.",
+    }
+
+
+def _metric_id(name, labels):
+    return name + ''.join('|%s=%s' % item for item in sorted(labels.items()))
+
+
+def _format_labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % item
+                             for item in sorted(labels.items()))
+
+
+def observe(coll, name, value, **labels):
+    """Record an observation of a histogram."""
+    _, buckets = HISTOGRAMS[name]
+    increments = {'count': 1, 'sum': value}
+    for i, bound in enumerate(buckets):
+        if value <= bound:
+            increments['buckets.%d' % i] = 1
+    coll.update_one({'_id': _metric_id(name, labels)},
+                    {'$set': {'name': name, 'labels': labels},
+                     '$inc': increments},
+                    upsert=True)
+    return
+
+
+def inc(coll, name, amount=1, **labels):
+    """Increase a counter."""
+    assert name in COUNTERS, "Unknown counter: %s" % name
+    coll.update_one({'_id': _metric_id(name, labels)},
+                    {'$set': {'name': name, 'labels': labels},
+                     '$inc': {'value': amount}},
+                    upsert=True)
+    return
+
+
+def render(coll, gauges=None):
+    """Render all the metrics in the Prometheus text format.
+
+    Gauges are measured by the caller at scrape time, and given as a dict
+    keyed by name, of (help, [(labels, value), ...]) tuples.
+    """
+    docs = {}
+    for doc in coll.find():
+        docs.setdefault(doc['name'], []).append(doc)
+
+    lines = []
+    for name, (help_str, buckets) in sorted(HISTOGRAMS.items()):
+        lines.append('# HELP %s %s' % (name, help_str))
+        lines.append('# TYPE %s histogram' % name)
+        for doc in docs.get(name, []):
+            labels = doc['labels']
+            for i, bound in enumerate(buckets):
+                lines.append('%s_bucket%s %d'
+                             % (name, _format_labels(labels, le=bound),
+                                doc.get('buckets', {}).get(str(i), 0)))
+            lines.append('%s_bucket%s %d'
+                         % (name, _format_labels(labels, le='+Inf'),
+                            doc['count']))
+            lines.append('%s_sum%s %s' % (name, _format_labels(labels),
+                                          doc['sum']))
+            lines.append('%s_count%s %d' % (name, _format_labels(labels),
+                                            doc['count']))
+
+    for name, help_str in sorted(COUNTERS.items()):
+        lines.append('# HELP %s %s' % (name, help_str))
+        lines.append('# TYPE %s counter' % name)
+        for doc in docs.get(name, []):
+            lines.append('%s%s %s' % (name, _format_labels(doc['labels']),
+                                      doc['value']))
+
+    for name, (help_str, values) in sorted((gauges or {}).items()):
+        lines.append('# HELP %s %s' % (name, help_str))
+        lines.append('# TYPE %s gauge' % name)
+        for labels, value in values:
+            lines.append('%s%s %s' % (name, _format_labels(labels), value))
+    return '\n'.join(lines) + '\n'